@@ -0,0 +1,328 @@
+"""
+Офлайн-бенчмарк backend: приложение запускается в том же процессе,
+а вместо Gemini работает локальная заглушка с настраиваемой задержкой.
+
+Примеры:
+    python benchmark.py
+    python benchmark.py --profile slow-tail --concurrency 64 --requests 500
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import types
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+import httpx
+import msgpack
+
+
+@dataclass
+class LatencyProfile:
+    """Профиль задержек заглушки LLM"""
+    name: str
+    first_token_latency: float  # Секунды до первого токена
+    tokens_per_second: float  # Скорость генерации
+    reply_tokens: int  # Длина ответа в токенах
+    jitter: float = 0.2  # Разброс задержки (доля, логнормальный)
+    tail_probability: float = 0.0  # Доля "медленных" ответов
+    tail_multiplier: float = 1.0  # Во сколько раз медленнее хвостовой ответ
+    error_rate: float = 0.0  # Доля ответов с ошибкой
+
+    def sample_first_token(self, rng: random.Random) -> float:
+        latency = self.first_token_latency * rng.lognormvariate(0, self.jitter)
+        if rng.random() < self.tail_probability:
+            latency *= self.tail_multiplier
+        return latency
+
+
+PROFILES = {
+    "instant": LatencyProfile("instant", 0.0, 1e9, 40, jitter=0.0),
+    "fast": LatencyProfile("fast", 0.15, 400, 60),
+    "typical": LatencyProfile("typical", 0.6, 120, 80),
+    "slow-tail": LatencyProfile("slow-tail", 0.6, 120, 80, tail_probability=0.05, tail_multiplier=8),
+    "flaky": LatencyProfile("flaky", 0.6, 120, 80, error_rate=0.05),
+}
+
+REPLY_WORDS = ["Здравствуйте", "спасибо", "за", "обращение", "доставка", "занимает",
+               "два", "дня", "уточните", "пожалуйста", "адрес", "и", "удобное", "время"]
+
+
+class FakeModels:
+    """Заглушка genai_client.aio.models с задержками по профилю"""
+
+    def __init__(self, profile: LatencyProfile, seed: int = 0):
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    def _reply_tokens(self):
+        return [self.rng.choice(REPLY_WORDS) for _ in range(self.profile.reply_tokens)]
+
+    def _maybe_fail(self):
+        if self.rng.random() < self.profile.error_rate:
+            raise RuntimeError("Заглушка LLM: имитация ошибки upstream")
+
+    async def get(self, model, config=None):
+        # Прогрев при старте приложения запрашивает метаданные модели
+        return types.SimpleNamespace(name=model)
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        tokens = self._reply_tokens()
+        await asyncio.sleep(self.profile.sample_first_token(self.rng)
+                            + len(tokens) / self.profile.tokens_per_second)
+        self._maybe_fail()
+        return types.SimpleNamespace(text=" ".join(tokens))
+
+    async def generate_content_stream(self, model, contents, config=None):
+        self.calls += 1
+        tokens = self._reply_tokens()
+        first_token = self.profile.sample_first_token(self.rng)
+
+        async def stream():
+            await asyncio.sleep(first_token)
+            self._maybe_fail()
+            for token in tokens:
+                await asyncio.sleep(1 / self.profile.tokens_per_second)
+                yield types.SimpleNamespace(text=token + " ")
+
+        return stream()
+
+
+class FakeGenaiClient:
+    """Подменяет genai.Client: реальные запросы в сеть не уходят"""
+
+    def __init__(self, profile: LatencyProfile, seed: int = 0):
+        self.aio = types.SimpleNamespace(models=FakeModels(profile, seed))
+
+
+def load_app(profile: LatencyProfile, seed: int):
+    """Импортирует main.py и подставляет заглушку вместо клиента Gemini"""
+    try:
+        import config  # noqa: F401
+    except ImportError:
+        # Для офлайн-прогона настоящий ключ не нужен
+        offline_config = types.ModuleType("config")
+        offline_config.API_KEY = "offline-benchmark"
+        offline_config.USE_CUSTOM_ENDPOINT = False
+        offline_config.CUSTOM_API_URL = ""
+        offline_config.MODEL_NAME = "fake-model"
+        sys.modules["config"] = offline_config
+
+    import main
+    main.genai_client = FakeGenaiClient(profile, seed)
+    # Бенчмарк меряет сервер, а не квоты клиентов
+    main.CLIENT_RATE_LIMIT = 0
+    main.CLIENT_IP_RATE_LIMIT = 0
+    return main
+
+
+def generate_dialog(length: int, rng: random.Random, unique: str = "") -> dict:
+    """Синтетический диалог VK заданной длины (epoch-время, id сообщений)"""
+    phrases = [
+        "Здравствуйте! Сколько стоит доставка?",
+        "Добрый день, доставка по городу 300 рублей.",
+        "А в выходные привозите?",
+        "Да, в субботу с 10 до 18.",
+        "Можно оплатить картой курьеру?",
+        "Конечно, у курьера есть терминал.",
+        "Отлично, тогда оформляю заказ.",
+    ]
+    timestamp = int(time.time()) - length * 120
+    messages = []
+    for i in range(length):
+        timestamp += rng.randint(5, 240)
+        messages.append({
+            "id": str(1000 + i),
+            "author": "Клиент" if i % 2 == 0 else "Вы",
+            "timestamp": timestamp,
+            "content": rng.choice(phrases),
+        })
+    # Уникальная приписка, чтобы запросы не попадали в кэш и не объединялись
+    messages[-1]["content"] += unique
+    return {"messages": messages, "context": ""}
+
+
+def to_columnar(dialog: dict) -> dict:
+    """Диалог в компактном колоночном формате"""
+    authors = ["Клиент", "Вы"]
+    messages = dialog["messages"]
+    return {
+        "authors": authors,
+        "author": [authors.index(msg["author"]) for msg in messages],
+        "timestamp": [msg["timestamp"] for msg in messages],
+        "content": [msg["content"] for msg in messages],
+        "id": [msg["id"] for msg in messages],
+        "context": dialog["context"],
+    }
+
+
+def encode_body(dialog: dict, wire: str):
+    """Тело запроса и заголовки для выбранного формата"""
+    if wire == "msgpack":
+        return msgpack.packb(to_columnar(dialog)), {"content-type": "application/msgpack"}
+    if wire == "columnar":
+        return json.dumps(to_columnar(dialog)).encode("utf-8"), {"content-type": "application/json"}
+    return json.dumps(dialog).encode("utf-8"), {"content-type": "application/json"}
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def run_scenario(client: httpx.AsyncClient, endpoint: str, length: int, args, rng: random.Random) -> dict:
+    """Закрытая нагрузка: concurrency воркеров шлют запросы, пока не наберётся args.requests"""
+    bodies = []
+    for i in range(args.requests):
+        dialog = generate_dialog(length, rng, unique="" if args.repeat else f" #{i}")
+        bodies.append(encode_body(dialog, args.wire))
+
+    latencies = []
+    errors = 0
+    next_index = 0
+
+    async def worker(worker_index: int):
+        nonlocal next_index, errors
+        # Воркеры распределены по клиентам, чтобы нагрузка шла через честную очередь
+        client_headers = {"x-install-id": f"benchmark-{worker_index % args.clients}"}
+        while next_index < len(bodies):
+            body, headers = bodies[next_index]
+            next_index += 1
+            start = time.perf_counter()
+            async with client.stream("POST", endpoint, content=body,
+                                     headers={**headers, **client_headers}) as response:
+                failed = response.status_code != 200
+                async for line in response.aiter_lines():
+                    # Ошибка потока приходит событием, а не статусом
+                    failed = failed or line.startswith("event: error")
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(i) for i in range(args.concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "endpoint": endpoint,
+        "messages": length,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+async def run_benchmark(args) -> dict:
+    profile = PROFILES[args.profile]
+    main = load_app(profile, args.seed)
+
+    rng = random.Random(args.seed)
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    # ASGITransport не вызывает lifespan - запускаем и останавливаем приложение сами
+    async with main.lifespan(main.app), \
+            httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        await main.warmup_task
+        for endpoint in args.endpoints:
+            for length in args.lengths:
+                result = await run_scenario(client, endpoint, length, args, rng)
+                results.append(result)
+                print(f"{endpoint:<22} {length:>5} сообщ. | {result['rps']:>8.1f} RPS | "
+                      f"p50 {result['p50_ms']:>8.1f} мс | p95 {result['p95_ms']:>8.1f} мс | "
+                      f"p99 {result['p99_ms']:>8.1f} мс | ошибок {result['errors']}")
+
+    return {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "profile": asdict(profile),
+        "concurrency": args.concurrency,
+        "clients": args.clients,
+        "requests_per_scenario": args.requests,
+        "wire": args.wire,
+        "repeat": args.repeat,
+        "llm_calls": main.genai_client.aio.models.calls,
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float):
+    """Сравнивает результаты с сохранённым прогоном; True, если регрессий нет"""
+    print()
+    print("=== СРАВНЕНИЕ С БАЗОВЫМ ПРОГОНОМ ===")
+    baseline_results = {(r["endpoint"], r["messages"]): r for r in baseline["results"]}
+    ok = True
+    for result in current["results"]:
+        base = baseline_results.get((result["endpoint"], result["messages"]))
+        if base is None:
+            continue
+        changes = []
+        for metric in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+            if not base[metric]:
+                continue
+            delta = (result[metric] - base[metric]) / base[metric]
+            # Для RPS хуже - меньше, для задержек - больше
+            regression = -delta if metric == "rps" else delta
+            mark = "❌" if regression > threshold else "  "
+            ok = ok and regression <= threshold
+            changes.append(f"{mark}{metric} {delta:+.1%}")
+        print(f"{result['endpoint']:<22} {result['messages']:>5} сообщ. | " + " | ".join(changes))
+    return ok
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк Respondo backend")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="typical",
+                        help="профиль задержек заглушки LLM")
+    parser.add_argument("--endpoints", nargs="+", default=["/api/suggest-reply", "/api/test"])
+    parser.add_argument("--lengths", nargs="+", type=int, default=[5, 50, 500],
+                        help="длины синтетических диалогов")
+    parser.add_argument("--requests", type=int, default=200, help="запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременных клиентов")
+    parser.add_argument("--clients", type=int, default=1, help="разных клиентов API (X-Install-Id)")
+    parser.add_argument("--wire", choices=["json", "columnar", "msgpack"], default="json",
+                        help="формат тела запроса")
+    parser.add_argument("--repeat", action="store_true",
+                        help="одинаковые диалоги (проверка кэша и объединения запросов)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="сохранить результаты в JSON-файл")
+    parser.add_argument("--compare", help="сравнить с ранее сохранённым JSON-файлом")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="допустимое ухудшение при сравнении (доля)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print("=" * 50)
+    print(f"БЕНЧМАРК RESPONDO BACKEND (профиль: {args.profile})")
+    print("=" * 50)
+
+    report = asyncio.run(run_benchmark(args))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.threshold):
+            print("\n❌ Обнаружены регрессии")
+            sys.exit(1)
+        print("\n✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,43 @@
-from fastapi import FastAPI, HTTPException
+import time
+
+# Время импорта модуля отдаётся в GET /ready (холодный старт реплики)
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers
 from pydantic import BaseModel
-from typing import List
-from datetime import datetime
-from google import genai
-from google.genai import types
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import asyncio
+import difflib
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import math
 import os
+import random
+import re
+import threading
+import zlib
 from pathlib import Path
 
+import httpx
+import msgpack
+import numpy as np
+import orjson
+import zstandard
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
 # Импортируем настройки из config.py
 try:
     from config import API_KEY, USE_CUSTOM_ENDPOINT, CUSTOM_API_URL, MODEL_NAME
@@ -21,18 +51,491 @@ except ImportError:
         "  MODEL_NAME = 'gemini-2.0-flash-lite'  # Название модели"
     )
 
-# Инициализируем Google Genai клиент
-if USE_CUSTOM_ENDPOINT:
-    print(f"🔧 Используется custom endpoint: {CUSTOM_API_URL}")
-    genai_client = genai.Client(
-        api_key=API_KEY,
-        http_options=types.HttpOptions(base_url=CUSTOM_API_URL)
-    )
-else:
+# Необязательные настройки производительности (можно переопределить в config.py)
+import config as _config
+
+# Сколько вызовов LLM одновременно выполняется в одном процессе
+LLM_MAX_CONCURRENCY = getattr(_config, "LLM_MAX_CONCURRENCY", 32)
+# Сколько запросов может ждать свободного слота; остальные сразу получают 503
+LLM_MAX_QUEUE = getattr(_config, "LLM_MAX_QUEUE", 64)
+# Сколько секунд запрос готов ждать в очереди, прежде чем получить 503
+LLM_QUEUE_TIMEOUT = getattr(_config, "LLM_QUEUE_TIMEOUT", 10.0)
+# Кэш ответов LLM для одинаковых диалогов: максимум записей и время жизни в секундах
+RESPONSE_CACHE_MAX_SIZE = getattr(_config, "RESPONSE_CACHE_MAX_SIZE", 1024)
+RESPONSE_CACHE_TTL = getattr(_config, "RESPONSE_CACHE_TTL", 300.0)
+# Серверные сессии диалогов (по peer id VK): сколько сессий и сообщений в каждой держим,
+# и через сколько секунд бездействия сессия забывается
+SESSION_MAX_COUNT = getattr(_config, "SESSION_MAX_COUNT", 1000)
+SESSION_MAX_MESSAGES = getattr(_config, "SESSION_MAX_MESSAGES", 500)
+SESSION_IDLE_TTL = getattr(_config, "SESSION_IDLE_TTL", 3600.0)
+# Бюджет токенов на историю диалога в промпте (0 - без ограничения). Последние сообщения
+# идут в промпт как есть, более ранние заменяются кратким содержанием
+PROMPT_HISTORY_TOKEN_BUDGET = getattr(_config, "PROMPT_HISTORY_TOKEN_BUDGET", 3000)
+# Граница "ранней" части выравнивается на блоки сообщений, чтобы краткое содержание
+# одного и того же префикса переиспользовалось между запросами
+SUMMARY_BLOCK_SIZE = getattr(_config, "SUMMARY_BLOCK_SIZE", 20)
+SUMMARY_CACHE_MAX_SIZE = getattr(_config, "SUMMARY_CACHE_MAX_SIZE", 512)
+SUMMARY_CACHE_TTL = getattr(_config, "SUMMARY_CACHE_TTL", 3600.0)
+# Пакетная обработка: максимум диалогов в одном пакете и сколько из них идут параллельно
+BATCH_MAX_ITEMS = getattr(_config, "BATCH_MAX_ITEMS", 500)
+BATCH_MAX_PARALLEL = getattr(_config, "BATCH_MAX_PARALLEL", 8)
+# Максимальный размер тела запроса после распаковки gzip/zstd (защита от "zip-бомб")
+MAX_DECOMPRESSED_BODY = getattr(_config, "MAX_DECOMPRESSED_BODY", 20 * 1024 * 1024)
+# Хеджирование: если основная модель не ответила за адаптивную задержку (квантиль её
+# времени ответа), тот же запрос уходит во вторую модель/endpoint; побеждает первый ответ
+LLM_HEDGE_ENABLED = getattr(_config, "LLM_HEDGE_ENABLED", False)
+HEDGE_MODEL_NAME = getattr(_config, "HEDGE_MODEL_NAME", MODEL_NAME)
+HEDGE_USE_CUSTOM_ENDPOINT = getattr(_config, "HEDGE_USE_CUSTOM_ENDPOINT", USE_CUSTOM_ENDPOINT)
+HEDGE_DELAY_QUANTILE = getattr(_config, "HEDGE_DELAY_QUANTILE", 0.9)
+HEDGE_INITIAL_DELAY = getattr(_config, "HEDGE_INITIAL_DELAY", 2.0)
+HEDGE_MIN_DELAY = getattr(_config, "HEDGE_MIN_DELAY", 0.3)
+HEDGE_MAX_DELAY = getattr(_config, "HEDGE_MAX_DELAY", 10.0)
+# Несколько вариантов ответа: максимум на запрос, порог похожести для отсева дублей
+# и умеет ли модель возвращать несколько вариантов за один вызов (candidate_count)
+CANDIDATES_MAX = getattr(_config, "CANDIDATES_MAX", 5)
+CANDIDATE_SIMILARITY = getattr(_config, "CANDIDATE_SIMILARITY", 0.9)
+LLM_CANDIDATE_COUNT_SUPPORTED = getattr(_config, "LLM_CANDIDATE_COUNT_SUPPORTED", True)
+# Индекс принятых ответов (опционально): похожий на уже отвеченный вопрос получает
+# принятый ранее ответ без вызова LLM, если косинусная близость не ниже порога
+REPLY_INDEX_ENABLED = getattr(_config, "REPLY_INDEX_ENABLED", False)
+REPLY_INDEX_DIR = getattr(_config, "REPLY_INDEX_DIR", "reply_index")
+REPLY_INDEX_THRESHOLD = getattr(_config, "REPLY_INDEX_THRESHOLD", 0.9)
+REPLY_INDEX_TAIL_MESSAGES = getattr(_config, "REPLY_INDEX_TAIL_MESSAGES", 3)  # Сколько последних сообщений сравнивать
+# Индекс отвечает только на вопрос клиента не короче REPLY_INDEX_MIN_CHARS символов:
+# "да", "спасибо", "ок" без контекста совпадают с чем угодно
+REPLY_INDEX_MIN_CHARS = getattr(_config, "REPLY_INDEX_MIN_CHARS", 15)
+# Авторы сообщений оператора (расширение подписывает исходящие как "Вы")
+OPERATOR_AUTHORS = getattr(_config, "OPERATOR_AUTHORS", ["Вы"])
+REPLY_INDEX_DIM = getattr(_config, "REPLY_INDEX_DIM", 512)  # Размер вектора хэшированных n-грамм
+REPLY_INDEX_SNAPSHOT_EVERY = getattr(_config, "REPLY_INDEX_SNAPSHOT_EVERY", 100)  # Новых записей до сохранения векторов
+# Журнал запросов /api/suggest-reply (опционально): пишется фоном пачками в gzip-файлы
+# с ротацией по размеру; персональные данные (телефоны, почта, карты, имена авторов) маскируются
+REQUEST_LOG_ENABLED = getattr(_config, "REQUEST_LOG_ENABLED", False)
+REQUEST_LOG_DIR = getattr(_config, "REQUEST_LOG_DIR", "request_logs")
+REQUEST_LOG_FLUSH_INTERVAL = getattr(_config, "REQUEST_LOG_FLUSH_INTERVAL", 2.0)
+REQUEST_LOG_BATCH_SIZE = getattr(_config, "REQUEST_LOG_BATCH_SIZE", 200)
+REQUEST_LOG_MAX_QUEUE = getattr(_config, "REQUEST_LOG_MAX_QUEUE", 10000)  # Сверх этого записи отбрасываются
+REQUEST_LOG_ROTATE_BYTES = getattr(_config, "REQUEST_LOG_ROTATE_BYTES", 50 * 1024 * 1024)
+REQUEST_LOG_KEEP_FILES = getattr(_config, "REQUEST_LOG_KEEP_FILES", 20)
+REQUEST_LOG_REDACT = getattr(_config, "REQUEST_LOG_REDACT", True)
+# Секрет для HMAC id диалогов и клиентов в журнале; без него берётся случайный на процесс
+# (тогда id одного диалога в журналах разных воркеров и запусков не совпадают)
+REQUEST_LOG_SECRET = getattr(_config, "REQUEST_LOG_SECRET", None)
+# Клиенты API: ключи из заголовка X-API-Key с именем, весом в честной очереди и лимитами,
+# например {"ключ": {"name": "support", "weight": 2, "rate": 5, "burst": 50}}.
+# Без ключа клиент определяется по X-Install-Id расширения (или по IP) и получает лимиты по умолчанию
+CLIENT_API_KEYS = getattr(_config, "CLIENT_API_KEYS", {})
+REQUIRE_API_KEY = getattr(_config, "REQUIRE_API_KEY", False)
+# Token bucket на клиента: средняя скорость (диалогов в секунду, 0 - без лимита) и допустимый всплеск
+CLIENT_RATE_LIMIT = getattr(_config, "CLIENT_RATE_LIMIT", 1.0)
+CLIENT_BURST = getattr(_config, "CLIENT_BURST", 30)
+# Общий token bucket на IP для всех клиентов без ключа: X-Install-Id присылает сам клиент,
+# и новый id не должен давать новый запас запросов (0 - без лимита)
+CLIENT_IP_RATE_LIMIT = getattr(_config, "CLIENT_IP_RATE_LIMIT", 5.0)
+CLIENT_IP_BURST = getattr(_config, "CLIENT_IP_BURST", 60)
+CLIENT_MAX_TRACKED = getattr(_config, "CLIENT_MAX_TRACKED", 10000)
+# Упреждающая генерация (prefetch): размер очереди диалогов, число фоновых обработчиков,
+# сколько слотов LLM оставлять свободными для интерактивных запросов и сколько хранить готовый ответ
+PREFETCH_MAX_QUEUE = getattr(_config, "PREFETCH_MAX_QUEUE", 100)
+PREFETCH_WORKERS = getattr(_config, "PREFETCH_WORKERS", 2)
+PREFETCH_RESERVED_SLOTS = getattr(_config, "PREFETCH_RESERVED_SLOTS", 4)
+PREFETCH_RESULT_TTL = getattr(_config, "PREFETCH_RESULT_TTL", 600.0)
+PREFETCH_MAX_RESULTS = getattr(_config, "PREFETCH_MAX_RESULTS", 1000)
+# Сколько секунд popup может ждать уже идущую генерацию (GET /api/prefetch/{peer_id}?wait=...)
+PREFETCH_MAX_WAIT = getattr(_config, "PREFETCH_MAX_WAIT", 15.0)
+# Файл системного промпта и как часто воркеры проверяют, не изменился ли он (секунды)
+PROMPT_FILE = getattr(_config, "PROMPT_FILE", "prompts/system_prompt.txt")
+PROMPT_CHECK_INTERVAL = getattr(_config, "PROMPT_CHECK_INTERVAL", 2.0)
+# Количество процессов uvicorn при запуске через python main.py
+WORKERS = getattr(_config, "WORKERS", 1)
+# Срок обработки запроса по умолчанию (клиент может передать свой в заголовке X-Request-Timeout)
+REQUEST_DEADLINE = getattr(_config, "REQUEST_DEADLINE", 60.0)
+# Таймаут вызова LLM подстраивается под наблюдаемое время ответа: p99 * множитель в пределах [MIN, MAX]
+LLM_TIMEOUT_INITIAL = getattr(_config, "LLM_TIMEOUT_INITIAL", 30.0)
+LLM_TIMEOUT_MIN = getattr(_config, "LLM_TIMEOUT_MIN", 5.0)
+LLM_TIMEOUT_MAX = getattr(_config, "LLM_TIMEOUT_MAX", 60.0)
+LLM_TIMEOUT_MULTIPLIER = getattr(_config, "LLM_TIMEOUT_MULTIPLIER", 2.0)
+# Повторы при временных ошибках (таймаут, 429, 5xx) с экспоненциальной задержкой и джиттером
+LLM_MAX_RETRIES = getattr(_config, "LLM_MAX_RETRIES", 2)
+LLM_RETRY_BASE_DELAY = getattr(_config, "LLM_RETRY_BASE_DELAY", 0.5)
+# Circuit breaker: после стольких ошибок подряд вызовы LLM сразу отклоняются с 503,
+# через CIRCUIT_RESET_TIMEOUT секунд пропускается один пробный вызов
+CIRCUIT_FAILURE_THRESHOLD = getattr(_config, "CIRCUIT_FAILURE_THRESHOLD", 5)
+CIRCUIT_RESET_TIMEOUT = getattr(_config, "CIRCUIT_RESET_TIMEOUT", 30.0)
+# Прогрев при старте (в фоне, пока /ready отвечает 503): открыть соединения с endpoint LLM
+# лёгким запросом метаданных модели и, по желанию, сделать один короткий вызов генерации
+STARTUP_WARM_CONNECTIONS = getattr(_config, "STARTUP_WARM_CONNECTIONS", True)
+STARTUP_WARMUP_CALL = getattr(_config, "STARTUP_WARMUP_CALL", False)
+STARTUP_WARMUP_TIMEOUT = getattr(_config, "STARTUP_WARMUP_TIMEOUT", 10.0)
+
+
+def create_genai_client(use_custom_endpoint: bool):
+    """Создаёт клиент Google Genai для стандартного или custom endpoint"""
+    # SDK импортируется здесь, а не при импорте модуля: это самая долгая часть холодного старта
+    from google import genai
+    from google.genai import types
+    
+    if use_custom_endpoint:
+        print(f"🔧 Используется custom endpoint: {CUSTOM_API_URL}")
+        return genai.Client(
+            api_key=API_KEY,
+            http_options=types.HttpOptions(base_url=CUSTOM_API_URL)
+        )
     print("🔧 Используется стандартный Google API endpoint")
-    genai_client = genai.Client(api_key=API_KEY)
+    return genai.Client(api_key=API_KEY)
+
+
+# Клиенты Google Genai создаются при первом обращении (обычно - фоновым прогревом при старте);
+# для хеджирования на другой endpoint нужен отдельный клиент
+genai_client = None
+hedge_genai_client = None
+# Прогрев создаёт клиентов в отдельном потоке - запрос, пришедший раньше, не должен создать второго
+genai_client_lock = threading.Lock()
+
+
+def get_genai_client(use_custom_endpoint: bool = USE_CUSTOM_ENDPOINT):
+    """Клиент Google Genai для endpoint; создаётся при первом обращении"""
+    global genai_client, hedge_genai_client
+    with genai_client_lock:
+        if use_custom_endpoint == USE_CUSTOM_ENDPOINT:
+            if genai_client is None:
+                genai_client = create_genai_client(use_custom_endpoint)
+            return genai_client
+        if hedge_genai_client is None:
+            hedge_genai_client = create_genai_client(use_custom_endpoint)
+        return hedge_genai_client
+
+# Метрики Prometheus (отдаются на GET /metrics)
+STARTUP_SECONDS = Gauge(
+    "respondo_startup_seconds",
+    "Время этапов холодного старта воркера (import, startup, warmup)",
+    ["phase"]
+)
+STAGE_SECONDS = Histogram(
+    "respondo_stage_seconds",
+    "Время этапов обработки запроса",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+REQUEST_SECONDS = Histogram(
+    "respondo_request_seconds",
+    "Полное время обработки запроса",
+    ["path"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+PROMPT_CHARS = Histogram(
+    "respondo_prompt_chars",
+    "Размер промпта, отправленного в LLM (символы)",
+    buckets=(500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+)
+RESPONSE_CHARS = Histogram(
+    "respondo_response_chars",
+    "Размер ответа LLM (символы)",
+    buckets=(50, 100, 200, 500, 1000, 2000, 5000)
+)
+UPSTREAM_ERRORS = Counter(
+    "respondo_upstream_errors_total",
+    "Ошибки при вызове LLM",
+    ["error"]
+)
+LLM_RETRIES = Counter(
+    "respondo_llm_retries_total",
+    "Повторные вызовы LLM после временных ошибок",
+    ["route"]
+)
+CIRCUIT_OPEN = Gauge(
+    "respondo_circuit_open",
+    "Circuit breaker маршрута LLM разомкнут (1) или нет (0)",
+    ["route"]
+)
+CLIENT_QUEUE_WAIT = Histogram(
+    "respondo_client_queue_wait_seconds",
+    "Ожидание слота LLM в честной очереди по клиентам (ключам API) и классам приоритета",
+    ["client", "priority"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+CLIENT_QUEUE_DEPTH = Gauge(
+    "respondo_client_queue_depth",
+    "Запросы клиента, ждущие слота LLM",
+    ["client"]
+)
+CLIENT_RATE_LIMITED = Counter(
+    "respondo_client_rate_limited_total",
+    "Запросы, отклонённые token bucket клиента",
+    ["client"]
+)
+REPLY_INDEX_LOOKUPS = Counter(
+    "respondo_reply_index_lookups_total",
+    "Поиск в индексе принятых ответов: hit, miss или skipped (последнее сообщение не подходит)",
+    ["result"]
+)
+REPLY_INDEX_SAVED = Counter(
+    "respondo_reply_index_latency_saved_seconds_total",
+    "Оценка времени LLM, сэкономленного ответами из индекса"
+)
+REQUEST_LOG_RECORDS = Counter(
+    "respondo_request_log_records_total",
+    "Записи журнала запросов по результату (written, dropped, failed)",
+    ["result"]
+)
+HEDGE_EVENTS = Counter(
+    "respondo_hedge_total",
+    "События хеджирования: sent, skipped, primary_win, hedge_win",
+    ["event"]
+)
+
+
+class RequestTimings:
+    """Время этапов одного запроса (секунды); этап может встречаться несколько раз"""
+
+    def __init__(self):
+        self.stages = {}
+        self.endpoint_done = None  # Момент, когда endpoint вернул результат
+        self.prompt_chars = None  # Размер промпта, отправленного в LLM (для журнала запросов)
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing (длительности в миллисекундах)"""
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items())
+
+
+# Тайминги текущего запроса (задачи asyncio наследуют их от запроса, который их создал)
+current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("current_timings", default=None)
+
+
+# Крайний срок текущего запроса (time.monotonic), None - без ограничения
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+# Класс приоритета текущего запроса: interactive (popup), batch или prefetch
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+PRIORITY_PREFETCH = "prefetch"
+PRIORITY_ORDER = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1, PRIORITY_PREFETCH: 2}
+request_priority: ContextVar[str] = ContextVar("request_priority", default=PRIORITY_INTERACTIVE)
+
+
+def remaining_deadline() -> float:
+    """Сколько секунд осталось до крайнего срока текущего запроса"""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return math.inf
+    return deadline - time.monotonic()
+
+
+def deadline_exceeded() -> HTTPException:
+    """Ошибка для запроса, у которого истёк его собственный срок (а не таймаут LLM)"""
+    return HTTPException(status_code=504, detail="Истёк срок обработки запроса")
+
+
+def start_deadline(timeout: Optional[float] = None):
+    """Назначает крайний срок текущему запросу (или задаче)"""
+    request_deadline.set(time.monotonic() + (timeout or REQUEST_DEADLINE))
+
+
+def record_stage(stage: str, seconds: float, timings: Optional[RequestTimings] = None):
+    """Записывает время этапа в гистограмму и в тайминги запроса (по умолчанию - текущего)"""
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    timings = timings or current_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+def record_prompt_size(chars: int):
+    """Запоминает размер промпта в данных текущего запроса"""
+    timings = current_timings.get()
+    if timings is not None:
+        timings.prompt_chars = chars
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """Замеряет время блока with как этап stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def decompress_body(body: bytes, encoding: str) -> bytes:
+    """
+    Распаковывает тело запроса по Content-Encoding (gzip или zstd)
+    """
+    if encoding in ("", "identity"):
+        return body
+    
+    try:
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = decompressor.decompress(body, MAX_DECOMPRESSED_BODY)
+            too_large = bool(decompressor.unconsumed_tail)
+        elif encoding == "zstd":
+            with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                data = reader.read(MAX_DECOMPRESSED_BODY + 1)
+            too_large = len(data) > MAX_DECOMPRESSED_BODY
+        else:
+            raise HTTPException(
+                status_code=415,
+                detail=f"Неподдерживаемый Content-Encoding: {encoding} (поддерживаются gzip и zstd)"
+            )
+    except (zlib.error, zstandard.ZstdError) as e:
+        raise HTTPException(status_code=400, detail=f"Не удалось распаковать тело запроса: {e}")
+    
+    if too_large:
+        raise HTTPException(status_code=413, detail="Тело запроса после распаковки слишком большое")
+    return data
+
 
-app = FastAPI(title="Respondo Backend")
+def expand_columnar_dialog(data):
+    """
+    Разворачивает колоночный формат диалога в обычный:
+    {"authors": ["Клиент", "Вы"], "author": [0, 1], "timestamp": [epoch, ...],
+     "content": [...], "id": [...]} -> {"messages": [{"author", "timestamp", "content", "id"}, ...]}
+    Остальные поля (context, peer_id и т.д.) остаются как есть.
+    """
+    if not isinstance(data, dict):
+        return data
+    
+    # Пакетный запрос: разворачиваем каждый диалог
+    if isinstance(data.get("requests"), list):
+        data["requests"] = [expand_columnar_dialog(item) for item in data["requests"]]
+        return data
+    
+    if "authors" not in data or "messages" in data:
+        return data
+    
+    authors = data.pop("authors")
+    author_refs = data.pop("author", [])
+    timestamps = data.pop("timestamp", [])
+    contents = data.pop("content", [])
+    ids = data.pop("id", None)
+    
+    if len(author_refs) != len(contents) or len(timestamps) != len(contents) \
+            or (ids is not None and len(ids) != len(contents)):
+        raise HTTPException(
+            status_code=422,
+            detail="Колонки author, timestamp, content и id должны быть одной длины"
+        )
+    
+    # Отрицательный индекс Python принял бы молча (-1 - последний автор), поэтому проверяем сами
+    if not isinstance(authors, list) or not all(
+            isinstance(ref, int) and not isinstance(ref, bool) and 0 <= ref < len(authors)
+            for ref in author_refs):
+        raise HTTPException(status_code=422, detail="Неверный индекс автора в колонке author")
+    
+    messages = [
+        {"author": authors[ref], "timestamp": ts if ts is not None else "", "content": content}
+        for ref, ts, content in zip(author_refs, timestamps, contents)
+    ]
+    
+    if ids is not None:
+        for message, message_id in zip(messages, ids):
+            message["id"] = str(message_id) if message_id is not None else None
+    
+    data["messages"] = messages
+    return data
+
+
+class CompactRequest(Request):
+    """
+    Запрос, тело которого может быть сжато (gzip/zstd), закодировано в msgpack
+    и/или передано в колоночном формате. FastAPI получает уже обычный словарь.
+    """
+
+    def __init__(self, scope, receive):
+        super().__init__(scope, receive)
+        content_type = self.headers.get("content-type", "").split(";")[0].strip().lower()
+        self.is_msgpack = content_type in MSGPACK_CONTENT_TYPES
+        if self.is_msgpack:
+            # FastAPI разбирает только JSON-тела, поэтому msgpack отдаём ему через json()
+            raw_headers = [(k, v) for k, v in scope["headers"] if k != b"content-type"]
+            self._headers = Headers(raw=raw_headers + [(b"content-type", b"application/json")])
+
+    async def body(self) -> bytes:
+        if not hasattr(self, "_decoded_body"):
+            raw_body = await super().body()
+            encoding = self.headers.get("content-encoding", "").strip().lower()
+            self._decoded_body = decompress_body(raw_body, encoding)
+        return self._decoded_body
+
+    async def json(self):
+        if not hasattr(self, "_json"):
+            with timed_stage("decode"):
+                body = await self.body()
+                data = msgpack.unpackb(body) if self.is_msgpack else orjson.loads(body)
+                self._json = expand_columnar_dialog(data)
+        return self._json
+
+
+class CompactRoute(APIRoute):
+    """
+    Маршрут, принимающий тела запросов в компактных форматах (см. CompactRequest).
+    Заодно замеряет этапы запроса и добавляет заголовок Server-Timing.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*args, **endpoint_kwargs):
+            result = await endpoint(*args, **endpoint_kwargs)
+            # Всё, что идёт после endpoint (до ответа), - сериализация
+            timings = current_timings.get()
+            if timings is not None:
+                timings.endpoint_done = time.perf_counter()
+            return result
+
+        super().__init__(path, timed_endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def compact_handler(request: Request):
+            timings = RequestTimings()
+            token = current_timings.set(timings)
+            
+            # Срок запроса: из заголовка X-Request-Timeout (секунды), но не больше REQUEST_DEADLINE
+            try:
+                timeout = min(float(request.headers.get("x-request-timeout", REQUEST_DEADLINE)), REQUEST_DEADLINE)
+            except ValueError:
+                timeout = REQUEST_DEADLINE
+            deadline_token = request_deadline.set(time.monotonic() + timeout)
+            client_token = current_client.set(client_registry.identify(request))
+            
+            start = time.perf_counter()
+            try:
+                response = await handler(CompactRequest(request.scope, request.receive))
+            finally:
+                current_timings.reset(token)
+                request_deadline.reset(deadline_token)
+                current_client.reset(client_token)
+            
+            finished = time.perf_counter()
+            if timings.endpoint_done is not None:
+                record_stage("serialize", finished - timings.endpoint_done, timings)
+            timings.add("total", finished - start)
+            REQUEST_SECONDS.labels(path=self.path).observe(finished - start)
+            
+            response.headers["Server-Timing"] = timings.server_timing()
+            return response
+
+        return compact_handler
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск и остановка приложения (вместо устаревших on_event)"""
+    await startup_event()
+    yield
+    await shutdown_event()
+
+
+app = FastAPI(title="Respondo Backend", lifespan=lifespan)
+app.router.route_class = CompactRoute
 
 # Настройка CORS для работы с расширением браузера
 app.add_middleware(
@@ -41,189 +544,2266 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
-# Глобальная переменная для системного промпта
+# Глобальная переменная для системного промпта и его версия (хэш содержимого)
 SYSTEM_PROMPT = None
+SYSTEM_PROMPT_VERSION = None
+
+
+class ClientInfo:
+    """Клиент API: от него зависят вес в честной очереди и лимит запросов"""
+
+    def __init__(self, client_id: str, name: str, weight: float = 1.0,
+                 rate: Optional[float] = None, burst: Optional[float] = None,
+                 authenticated: bool = False, address: Optional[str] = None):
+        self.id = client_id
+        self.name = name
+        self.weight = weight
+        self.rate = CLIENT_RATE_LIMIT if rate is None else rate
+        self.burst = CLIENT_BURST if burst is None else burst
+        self.authenticated = authenticated
+        self.address = address  # IP клиента без ключа - для общего лимита по адресу
+        # Метка в /metrics: только имена из CLIENT_API_KEYS, иначе число рядов растёт
+        # с каждым новым X-Install-Id или IP
+        self.metric_label = name if authenticated else "anonymous"
 
 
-def load_system_prompt(prompt_file: str = "prompts/system_prompt.txt") -> str:
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше burst в запасе"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, cost: float = 1.0) -> float:
+        """Списывает cost токенов; если их не хватает - возвращает, сколько секунд ждать"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class ClientStats:
+    """Счётчики одного клиента для GET /"""
+
+    def __init__(self, client: ClientInfo):
+        self.client = client
+        self.bucket = TokenBucket(client.rate, client.burst)
+        self.requests = 0
+        self.rate_limited = 0
+        self.waiting = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+
+
+class ClientRegistry:
     """
-    Загружает системный промпт из файла.
-    Извлекает только содержимое внутри фигурных скобок {}.
-    Всё остальное считается комментариями и игнорируется.
+    Определяет клиента по заголовкам запроса и следит за его лимитами.
     
-    Args:
-        prompt_file: путь к файлу с промптом
+    - X-API-Key из CLIENT_API_KEYS: имя, вес и лимиты из конфига
+    - X-Install-Id (id установки расширения) или IP: лимиты по умолчанию
+      и вдобавок общий token bucket на IP
+    """
+
+    def __init__(self, api_keys: dict, require_api_key: bool, max_tracked: int):
+        self.require_api_key = require_api_key
+        self.max_tracked = max_tracked
+        self._keys: Dict[str, ClientInfo] = {}
+        for key, settings in api_keys.items():
+            name = settings.get("name") or f"key:{hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]}"
+            self._keys[key] = ClientInfo(
+                client_id=name,
+                name=name,
+                weight=settings.get("weight", 1.0),
+                rate=settings.get("rate"),
+                burst=settings.get("burst"),
+                authenticated=True
+            )
+        self._clients: "OrderedDict[str, ClientStats]" = OrderedDict()
+        self._addresses: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def identify(self, request: Request) -> ClientInfo:
+        api_key = request.headers.get("x-api-key")
+        if api_key and api_key in self._keys:
+            return self._keys[api_key]
+        
+        address = "ip:" + (request.client.host if request.client else "unknown")
+        install_id = request.headers.get("x-install-id")
+        if install_id:
+            # Сам id установки в метки и статистику не попадает
+            client_id = "install:" + hashlib.sha256(install_id.encode("utf-8")).hexdigest()[:12]
+        else:
+            client_id = address
+        return ClientInfo(client_id=client_id, name=client_id, address=address)
+
+    def stats_for(self, client: ClientInfo) -> ClientStats:
+        stats = self._clients.get(client.id)
+        if stats is None:
+            stats = ClientStats(client)
+            self._clients[client.id] = stats
+            while len(self._clients) > self.max_tracked:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(client.id)
+        return stats
+
+    def _consume(self, client: ClientInfo, stats: ClientStats, cost: float) -> float:
+        """
+        Списывает cost с bucket клиента, а у клиента без ключа - сначала с общего bucket
+        его IP. Возвращает, сколько секунд ждать, если токенов не хватило
+        """
+        if client.address is not None:
+            bucket = self._addresses.get(client.address)
+            if bucket is None:
+                bucket = self._addresses[client.address] = TokenBucket(CLIENT_IP_RATE_LIMIT, CLIENT_IP_BURST)
+                while len(self._addresses) > self.max_tracked:
+                    self._addresses.popitem(last=False)
+            else:
+                self._addresses.move_to_end(client.address)
+            retry_after = bucket.consume(cost)
+            if retry_after > 0:
+                return retry_after
+        return stats.bucket.consume(cost)
+
+    def admit(self, cost: float = 1.0) -> ClientInfo:
+        """
+        Пропускает запрос текущего клиента к LLM: 401 без ключа (если он обязателен),
+        429 с Retry-After, если клиент исчерпал свой token bucket (или общий bucket своего IP)
+        """
+        client = current_client.get() or ANONYMOUS_CLIENT
+        if self.require_api_key and not client.authenticated:
+            raise HTTPException(status_code=401, detail="Нужен действительный ключ API в заголовке X-API-Key")
+        
+        stats = self.stats_for(client)
+        stats.requests += 1
+        retry_after = self._consume(client, stats, cost)
+        if retry_after > 0:
+            stats.rate_limited += 1
+            CLIENT_RATE_LIMITED.labels(client=client.metric_label).inc()
+            raise HTTPException(
+                status_code=429,
+                detail=f"Слишком много запросов от клиента {client.name}",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+            )
+        return client
+
+    async def throttle(self, cost: float = 1.0):
+        """
+        Ждёт, пока у текущего клиента накопятся токены, и списывает их.
+        Для элементов пакета: пакет больше burst не отклоняется, а идёт со скоростью лимита клиента
+        """
+        client = current_client.get() or ANONYMOUS_CLIENT
+        stats = self.stats_for(client)
+        stats.requests += 1
+        while True:
+            retry_after = self._consume(client, stats, cost)
+            if retry_after <= 0:
+                return
+            await asyncio.sleep(retry_after)
+
+    def stats(self) -> dict:
+        return {
+            stats.client.name: {
+                "weight": stats.client.weight,
+                "requests": stats.requests,
+                "rate_limited": stats.rate_limited,
+                "tokens_left": round(stats.bucket.tokens, 2),
+                "queue_depth": stats.waiting,
+                "avg_queue_wait": round(stats.wait_seconds / stats.waited, 4) if stats.waited else 0.0,
+            }
+            for stats in self._clients.values()
+        }
+
+
+ANONYMOUS_CLIENT = ClientInfo(client_id="anonymous", name="anonymous")
+
+# Клиент текущего запроса (определяется в CompactRoute по заголовкам)
+current_client: ContextVar[Optional[ClientInfo]] = ContextVar("current_client", default=None)
+
+client_registry = ClientRegistry(CLIENT_API_KEYS, REQUIRE_API_KEY, CLIENT_MAX_TRACKED)
+
+
+class LLMConcurrencyLimiter:
+    """
+    Ограничивает число одновременных вызовов LLM внутри процесса.
+    Запросы сверх лимита ждут в очереди ограниченной длины;
+    если очередь заполнена или ожидание затянулось - сразу 503.
     
-    Returns:
-        str: содержимое промпта из фигурных скобок
+    Очередь честная: сначала по классу приоритета (interactive, batch, prefetch),
+    внутри класса - взвешенно по клиентам (start-time fair queueing), чтобы
+    один активный клиент не занимал все слоты.
     """
-    try:
-        prompt_path = Path(__file__).parent / prompt_file
-        with open(prompt_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Ищем содержимое между { и }
-        import re
-        match = re.search(r'\{(.*?)\}', content, re.DOTALL)
-        
-        if match:
-            prompt = match.group(1).strip()
-            print(f"✅ Промпт извлечён из фигурных скобок")
-            return prompt
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._free = max_concurrency
+        # Куча (класс приоритета, виртуальное время старта, порядковый номер, future)
+        self._waiters = []
+        self._virtual_time = 0.0
+        self._client_finish: Dict[str, float] = {}  # Виртуальное время окончания по клиентам
+        self._seq = itertools.count()
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def _enqueue(self, client: ClientInfo, priority: str) -> asyncio.Future:
+        # Клиент с весом w продвигается по виртуальному времени в w раз медленнее остальных
+        start = max(self._virtual_time, self._client_finish.get(client.id, 0.0))
+        self._client_finish[client.id] = start + 1.0 / client.weight
+        if len(self._client_finish) > CLIENT_MAX_TRACKED:
+            # Клиенты, отставшие от виртуального времени, ничего не теряют при удалении
+            self._client_finish = {
+                client_id: finish for client_id, finish in self._client_finish.items()
+                if finish > self._virtual_time
+            }
+        
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITY_ORDER.get(priority, 0), start, next(self._seq), waiter))
+        return waiter
+
+    def _release(self):
+        """Передаёт освободившийся слот следующему в очереди"""
+        while self._waiters:
+            _, start, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                continue  # Ожидающий уже ушёл (таймаут или отмена)
+            self._virtual_time = start
+            waiter.set_result(None)
+            return
+        self._free += 1
+
+    def _abandon(self, waiter: asyncio.Future):
+        if waiter.done() and not waiter.cancelled():
+            # Слот успели передать - отдаём его следующему
+            self._release()
+        else:
+            waiter.cancel()
+
+    def _reject(self, reason: str) -> HTTPException:
+        self.rejected += 1
+        return HTTPException(
+            status_code=503,
+            detail=f"Сервер перегружен: {reason}",
+            headers={"Retry-After": "1"}
+        )
+
+    @asynccontextmanager
+    async def slot(self):
+        """Занимает слот для вызова LLM на время блока async with"""
+        queued_at = time.perf_counter()
+        if self._free > 0:
+            # Свободный слот есть - занимаем без ожидания
+            self._free -= 1
         else:
-            print(f"⚠️  Фигурные скобки не найдены в файле. Используется весь файл как промпт.")
-            return content.strip()
+            if self.waiting >= self.max_queue:
+                raise self._reject("очередь запросов к LLM заполнена")
+
+            # Ждать дольше, чем осталось до крайнего срока запроса, бессмысленно
+            queue_timeout = min(self.queue_timeout, remaining_deadline())
+            if queue_timeout <= 0:
+                raise self._reject("истёк срок обработки запроса")
+
+            client = current_client.get() or ANONYMOUS_CLIENT
+            priority = request_priority.get()
+            client_stats = client_registry.stats_for(client)
+            waiter = self._enqueue(client, priority)
+            self.waiting += 1
+            client_stats.waiting += 1
+            CLIENT_QUEUE_DEPTH.labels(client=client.metric_label).inc()
+            try:
+                # wait, а не wait_for: future не должен отменяться, если слот уже передан
+                done, _ = await asyncio.wait({waiter}, timeout=queue_timeout)
+            except asyncio.CancelledError:
+                self._abandon(waiter)
+                raise
+            finally:
+                self.waiting -= 1
+                client_stats.waiting -= 1
+                CLIENT_QUEUE_DEPTH.labels(client=client.metric_label).dec()
+            if not done:
+                self._abandon(waiter)
+                raise self._reject("превышено время ожидания в очереди к LLM")
             
-    except FileNotFoundError:
-        print(f"⚠️  Файл {prompt_file} не найден. Используется дефолтный промпт.")
-        # Дефолтный промпт
-        return """Ты - умный ассистент для анализа диалогов и формирования ответов.
+            waited = time.perf_counter() - queued_at
+            client_stats.waited += 1
+            client_stats.wait_seconds += waited
+            CLIENT_QUEUE_WAIT.labels(client=client.metric_label, priority=priority).observe(waited)
 
-ТВОЯ ЗАДАЧА:
-Проанализировать историю диалога с учётом временных меток и предложить уместный, естественный ответ.
+        record_stage("queue", time.perf_counter() - queued_at)
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._release()
 
-ВРЕМЕННОЙ КОНТЕКСТ:
-- Обращай внимание на время между сообщениями
-- Долгие паузы (несколько часов/дней) могут требовать более вежливого возобновления диалога
-- Быстрые ответы указывают на активную беседу
-- Если последнее сообщение было давно, учти это в тоне ответа
+    def has_free_slot(self) -> bool:
+        return self._free > 0
 
-ПРАВИЛА:
-- Отвечай на том же языке, что и диалог
-- Сохраняй тон и стиль беседы (формальный/неформальный)
-- Будь кратким и по существу
-- Отвечай на заданные вопросы
-- Не повторяй уже сказанное
-- Будь вежливым и естественным
+    def free_slots(self) -> int:
+        """Сколько вызовов можно начать прямо сейчас без очереди"""
+        return self._free
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+        }
+
+
+llm_limiter = LLMConcurrencyLimiter(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT)
+
+Gauge("respondo_llm_active", "Вызовы LLM, выполняющиеся сейчас").set_function(lambda: llm_limiter.active)
+Gauge("respondo_llm_waiting", "Запросы, ждущие слота для вызова LLM").set_function(lambda: llm_limiter.waiting)
+
+
+class ResponseCache:
+    """
+    LRU-кэш готовых ответов LLM с ограничением размера и временем жизни записей
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # ключ -> (время истечения, ответ)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Union[str, List[str]]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Union[str, List[str]]):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Ответы на диалоги: список вариантов, первый - лучший
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_TTL)
+# Краткие содержания ранней части диалогов (ключ - хэш префикса сообщений)
+summary_cache = ResponseCache(SUMMARY_CACHE_MAX_SIZE, SUMMARY_CACHE_TTL)
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые запросы в один вызов LLM.
+    Все ожидающие получают один и тот же результат; если отключились все
+    ожидающие, вызов отменяется.
+    """
+
+    def __init__(self):
+        self._flights = {}  # ключ -> [задача, число ожидающих]
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def do(self, key: str, make_coro):
+        flight = self._flights.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(make_coro())
+            flight = self._flights[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, flight))
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            # shield: отмена одного ожидающего не должна отменять общий вызов
+            return await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                # Сразу забываем вызов: повторный запрос до срабатывания done-callback
+                # должен начать новый вызов, а не получить CancelledError от отменённого
+                self._forget(key, flight)
+                task.cancel()
+                self.cancelled += 1
+
+    def _forget(self, key: str, flight: list):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        requests_total = self.upstream_calls + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "dedup_rate": round(self.coalesced / requests_total, 4) if requests_total else 0.0,
+        }
+
+
+class StreamFlight:
+    """
+    Один потоковый вызов LLM, на который подписаны одинаковые запросы к потоковому endpoint.
+    Фрагменты ответа копятся в parts: подписчик сначала получает уже пришедшие, затем новые.
+    Итог вызова (все варианты ответа) - результат task.
+    """
+
+    def __init__(self, make_coro):
+        self.parts: List[str] = []
+        self.tokens_saved = 0
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(make_coro(self))
+        self.task.add_done_callback(self._finished)
+
+    def publish(self, text: str):
+        self.parts.append(text)
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _finished(self, task: asyncio.Task):
+        # Ошибку забирают подписчики; если их уже нет, asyncio не должен ругаться на неё
+        if not task.cancelled():
+            task.exception()
+        self._notify()
+
+    async def tokens(self) -> AsyncIterator[str]:
+        """Все фрагменты ответа с начала; заканчивается вместе с вызовом"""
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.parts):
+                yield self.parts[sent]
+                sent += 1
+            if self.task.done():
+                return
+            await changed.wait()
+
+
+class StreamSingleFlight:
+    """
+    Объединяет одновременные одинаковые запросы к потоковому endpoint: второй и следующие
+    подписываются на уже идущий поток и получают те же фрагменты. Когда отписались
+    все подписчики, вызов отменяется.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, StreamFlight] = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def join(self, key: str) -> Optional[StreamFlight]:
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        return flight
+
+    def start(self, key: str, make_coro) -> StreamFlight:
+        flight = StreamFlight(make_coro)
+        self._flights[key] = flight
+        flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        self.upstream_calls += 1
+        return flight
+
+    def subscribe(self, flight: StreamFlight):
+        flight.subscribers += 1
+
+    def unsubscribe(self, key: str, flight: StreamFlight):
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.task.done():
+            # Как в SingleFlight: повторный запрос должен начать новый вызов, а не получить отменённый
+            self._forget(key, flight)
+            flight.task.cancel()
+            self.cancelled += 1
+
+    def _forget(self, key: str, flight: StreamFlight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        requests_total = self.upstream_calls + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "dedup_rate": round(self.coalesced / requests_total, 4) if requests_total else 0.0,
+        }
+
+
+single_flight = SingleFlight()
+stream_flight = StreamSingleFlight()
+summary_flight = SingleFlight()
+
+
+async def wait_for_disconnect(http_request: Request):
+    """Завершается, когда клиент закрыл соединение"""
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_until_disconnect(http_request: Request, coro):
+    """
+    Выполняет coro, пока клиент на связи. Если клиент отключился раньше,
+    coro отменяется (вместе с ним - и вызов LLM, если больше никто его не ждёт).
+    """
+    work = asyncio.ensure_future(coro)
+    disconnect = asyncio.ensure_future(wait_for_disconnect(http_request))
+    try:
+        await asyncio.wait({work, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+    
+    if not work.done():
+        work.cancel()
+        raise HTTPException(status_code=499, detail="Клиент закрыл соединение")
+    return work.result()
+
+
+class ConversationSession:
+    """Накопленная история одного диалога: id сообщения -> сообщение"""
+
+    def __init__(self):
+        self.messages = OrderedDict()
+        self.last_seen = time.monotonic()
+
+    @property
+    def last_message_id(self) -> Optional[str]:
+        return next(reversed(self.messages), None)
+
+
+class ConversationStore:
+    """
+    Серверные сессии диалогов, чтобы клиент присылал только новые сообщения.
+    Сессия принадлежит клиенту: один и тот же peer_id у разных установок
+    или ключей API - разные сессии.
+    Память ограничена числом сессий (LRU) и сообщений в сессии,
+    неактивные сессии забываются через idle_ttl секунд.
+    """
+
+    def __init__(self, max_sessions: int, max_messages: int, idle_ttl: float):
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        # Ключ - (id клиента, peer_id)
+        self._sessions: "OrderedDict[Tuple[str, str], ConversationSession]" = OrderedDict()
+        self.messages_received = 0
+        self.messages_duplicated = 0
+        self.resyncs = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _expire_idle(self):
+        # Сессии упорядочены по последнему обращению - старые в начале
+        deadline = time.monotonic() - self.idle_ttl
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if session.last_seen >= deadline:
+                break
+            del self._sessions[key]
+            self.expired += 1
+
+    def sync(self, client: ClientInfo, peer_id: str, messages: list, base_message_id: Optional[str],
+             reset: bool = False) -> ConversationSession:
+        """
+        Добавляет в сессию новые сообщения и возвращает её.
+        base_message_id - последний id, который клиент уже отправлял;
+        если сервер его не знает, клиент должен пересинхронизироваться (409).
+        """
+        self._expire_idle()
+
+        key = (client.id, peer_id)
+        session = None if reset else self._sessions.get(key)
+        if session is None:
+            if base_message_id is not None and not reset:
+                self.resyncs += 1
+                raise HTTPException(
+                    status_code=409,
+                    detail="Сессия диалога не найдена, отправьте всю историю с reset_session=true"
+                )
+            session = ConversationSession()
+        elif base_message_id is not None and base_message_id not in session.messages:
+            self.resyncs += 1
+            raise HTTPException(
+                status_code=409,
+                detail="Сессия диалога рассинхронизирована, отправьте всю историю с reset_session=true"
+            )
+
+        for msg in messages:
+            self.messages_received += 1
+            if msg.id in session.messages:
+                self.messages_duplicated += 1
+            # Повторно присланное сообщение могло быть отредактировано - обновляем на месте
+            session.messages[msg.id] = msg
+
+        while len(session.messages) > self.max_messages:
+            session.messages.popitem(last=False)
+
+        session.last_seen = time.monotonic()
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+        return session
+
+    def drop(self, client: ClientInfo, peer_id: str) -> bool:
+        return self._sessions.pop((client.id, peer_id), None) is not None
+
+    def history(self, client: ClientInfo, peer_id: str) -> Optional[list]:
+        """Вся накопленная история диалога (без продления сессии)"""
+        session = self._sessions.get((client.id, peer_id))
+        return list(session.messages.values()) if session is not None else None
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "messages_stored": sum(len(s.messages) for s in self._sessions.values()),
+            "messages_received": self.messages_received,
+            "messages_duplicated": self.messages_duplicated,
+            "resyncs": self.resyncs,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+conversation_store = ConversationStore(SESSION_MAX_COUNT, SESSION_MAX_MESSAGES, SESSION_IDLE_TTL)
+
+
+class ReplyIndex:
+    """
+    Индекс пар "хвост диалога → принятый оператором ответ".
+    
+    Ключ - последнее сообщение клиента вместе с предыдущими (tail_messages всего);
+    диалоги, где последним писал оператор или вопрос слишком короткий, не ищутся
+    и не запоминаются. Ответы одного клиента API другим не выдаются.
+    Текст хвоста превращается в вектор хэшированных символьных триграмм и слов
+    (NumPy, только CPU), близость - косинус. Хранение на диске:
+    - entries.jsonl - сами пары, только дописывается (несколько воркеров могут писать одновременно)
+    - vectors.npy - снимок векторов, открывается через mmap и не читается в память целиком
+    Записи новее снимка векторизуются при загрузке и держатся в памяти до следующего снимка.
+    """
+
+    def __init__(self, directory: str, dim: int, threshold: float, tail_messages: int, min_chars: int,
+                 snapshot_every: int):
+        self.directory = Path(__file__).parent / directory
+        self.entries_path = self.directory / "entries.jsonl"
+        self.vectors_path = self.directory / "vectors.npy"
+        self.dim = dim
+        self.threshold = threshold
+        self.tail_messages = tail_messages
+        self.snapshot_every = snapshot_every
+        self.min_chars = min_chars
+        self._replies: List[str] = []
+        # Владелец записи (id клиента) - номером в _owner_codes, чтобы фильтровать векторно
+        self._owners = np.zeros(0, dtype=np.int32)
+        self._owner_codes: Dict[str, int] = {}
+        self._snapshot = np.zeros((0, dim), dtype=np.float32)  # np.memmap после загрузки снимка
+        self._tail = np.zeros((0, dim), dtype=np.float32)
+        self._offset = 0  # Сколько байт entries.jsonl уже прочитано
+        self._next_sync = 0.0
+        self._loaded = False
+        self.lookups = 0
+        self.hits = 0
+        self.skipped = 0
+        self.added = 0
+        self.lookup_seconds = 0.0
+        self.latency_saved = 0.0
+
+    def vectorize(self, text: str) -> np.ndarray:
+        normalized = " ".join("".join(ch for ch in text.lower() if ch.isalnum() or ch.isspace()).split())
+        padded = f" {normalized} "
+        features = [padded[i:i + 3] for i in range(len(padded) - 2)]
+        features += ["w:" + word for word in normalized.split()]
+        
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if features:
+            buckets = [zlib.crc32(feature.encode("utf-8")) % self.dim for feature in features]
+            np.add.at(vector, buckets, 1.0)
+            vector /= np.linalg.norm(vector)
+        return vector
+
+    def key_text(self, messages: List["Message"]) -> str:
+        return "\n".join(msg.content for msg in messages[-self.tail_messages:])
+
+    def eligible(self, messages: List["Message"]) -> bool:
+        """Последнее сообщение - содержательный вопрос клиента, а не реплика оператора или «ок»"""
+        if not messages or messages[-1].author in OPERATOR_AUTHORS:
+            return False
+        return len(" ".join(messages[-1].content.split())) >= self.min_chars
+
+    def _owner_code(self, client_id: Optional[str]) -> int:
+        return self._owner_codes.setdefault(client_id or "", len(self._owner_codes))
+
+    def _load(self):
+        self._loaded = True
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self.vectors_path.exists():
+            snapshot = np.load(self.vectors_path, mmap_mode="r")
+            if snapshot.ndim == 2 and snapshot.shape[1] == self.dim:
+                self._snapshot = snapshot
+            else:
+                print(f"⚠️  {self.vectors_path} создан с другим размером вектора и будет пересобран")
+        self._sync(force=True)
+        print(f"📚 Индекс принятых ответов: {len(self._replies)} записей")
+
+    def _sync(self, force: bool = False):
+        """Дочитывает записи, добавленные в entries.jsonl (в том числе другими воркерами)"""
+        now = time.monotonic()
+        if not force and now < self._next_sync:
+            return
+        self._next_sync = now + 1.0
+        if not self.entries_path.exists() or self.entries_path.stat().st_size <= self._offset:
+            return
+        
+        with open(self.entries_path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # Последняя строка может быть ещё недописана
+        complete = data[:data.rfind(b"\n") + 1]
+        self._offset += len(complete)
+        
+        new_vectors = []
+        new_owners = []
+        for line in complete.splitlines():
+            entry = orjson.loads(line)
+            index = len(self._replies)
+            self._replies.append(entry["reply"])
+            new_owners.append(self._owner_code(entry.get("client")))
+            if index >= len(self._snapshot):
+                new_vectors.append(self.vectorize(entry["key"]))
+        if len(self._snapshot) > len(self._replies):
+            # Снимок длиннее самих записей - файл записей заменили, векторы пересобираем
+            self._snapshot = np.zeros((0, self.dim), dtype=np.float32)
+            self._offset = 0
+            self._replies = []
+            self._owners = np.zeros(0, dtype=np.int32)
+            self._tail = np.zeros((0, self.dim), dtype=np.float32)
+            return self._sync(force=True)
+        if new_owners:
+            self._owners = np.concatenate([self._owners, np.array(new_owners, dtype=np.int32)])
+        if new_vectors:
+            self._tail = np.vstack([self._tail, np.array(new_vectors, dtype=np.float32)])
+
+    def _scores(self, vector: np.ndarray, client: ClientInfo) -> np.ndarray:
+        if len(self._tail) == 0:
+            scores = self._snapshot @ vector
+        else:
+            scores = np.concatenate([self._snapshot @ vector, self._tail @ vector])
+        # Записи других клиентов не участвуют
+        return np.where(self._owners == self._owner_code(client.id), scores, -1.0)
+
+    def search(self, client: ClientInfo, messages: List["Message"], limit: int = 1) -> List[Tuple[float, str]]:
+        """До limit разных ответов клиента с близостью не ниже порога, от самого похожего"""
+        if not self.eligible(messages):
+            self.skipped += 1
+            REPLY_INDEX_LOOKUPS.labels(result="skipped").inc()
+            return []
+        if not self._loaded:
+            self._load()
+        self._sync()
+        
+        start = time.perf_counter()
+        self.lookups += 1
+        found = []
+        if self._replies:
+            scores = self._scores(self.vectorize(self.key_text(messages)), client)
+            for index in np.argsort(-scores)[:limit * 4]:
+                score = float(scores[index])
+                if score < self.threshold:
+                    break
+                if self._replies[index] not in (reply for _, reply in found):
+                    found.append((round(score, 4), self._replies[index]))
+                if len(found) >= limit:
+                    break
+        elapsed = time.perf_counter() - start
+        self.lookup_seconds += elapsed
+        
+        if found:
+            self.hits += 1
+            REPLY_INDEX_LOOKUPS.labels(result="hit").inc()
+            # Без индекса ответ ждал бы типичное время вызова LLM
+            saved = max(llm_router.primary.typical_latency() - elapsed, 0.0)
+            self.latency_saved += saved
+            REPLY_INDEX_SAVED.inc(saved)
+        else:
+            REPLY_INDEX_LOOKUPS.labels(result="miss").inc()
+        return found
+
+    def add(self, client: ClientInfo, messages: List["Message"], reply: str) -> bool:
+        """
+        Запоминает принятый ответ клиента; точный повтор уже известной пары не добавляется.
+        Вызывающий код проверяет eligible(messages) заранее
+        """
+        if not self._loaded:
+            self._load()
+        self._sync(force=True)
+        
+        key = self.key_text(messages)
+        vector = self.vectorize(key)
+        if self._replies:
+            scores = self._scores(vector, client)
+            best = int(np.argmax(scores))
+            if scores[best] >= 0.99 and self._replies[best] == reply:
+                return False
+        
+        line = orjson.dumps({
+            "key": key,
+            "reply": reply,
+            "client": client.id,
+            "created_at": datetime.now().isoformat(timespec="seconds")
+        }) + b"\n"
+        # O_APPEND: строки из разных воркеров не перемешиваются
+        fd = os.open(self.entries_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self._sync(force=True)
+        self.added += 1
+        
+        if len(self._tail) >= self.snapshot_every:
+            self._save_snapshot()
+        return True
+
+    def _save_snapshot(self):
+        vectors = np.concatenate([np.asarray(self._snapshot), self._tail])
+        tmp_path = self.vectors_path.with_name(f"vectors.{os.getpid()}.tmp.npy")
+        np.save(tmp_path, vectors)
+        os.replace(tmp_path, self.vectors_path)
+        self._snapshot = np.load(self.vectors_path, mmap_mode="r")
+        self._tail = np.zeros((0, self.dim), dtype=np.float32)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "entries": len(self._replies),
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "skipped": self.skipped,
+            "added": self.added,
+            "avg_lookup_ms": round(self.lookup_seconds / self.lookups * 1000, 3) if self.lookups else 0.0,
+            "latency_saved_seconds": round(self.latency_saved, 3),
+        }
+
+
+reply_index = ReplyIndex(REPLY_INDEX_DIR, REPLY_INDEX_DIM, REPLY_INDEX_THRESHOLD, REPLY_INDEX_TAIL_MESSAGES,
+                         REPLY_INDEX_MIN_CHARS, REPLY_INDEX_SNAPSHOT_EVERY) if REPLY_INDEX_ENABLED else None
+
+
+# Персональные данные, которые не должны попадать в журнал
+PII_PATTERNS = [
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), "[email]"),
+    (re.compile(r"\b\d(?:[ -]?\d){12,18}\b"), "[card]"),
+    (re.compile(r"(?:\+7|\b8)[\s(-]*\d{3}[\s)-]*\d{3}[\s-]*\d{2}[\s-]*\d{2}\b"), "[phone]"),
+    (re.compile(r"(?:https?://)?(?:www\.)?vk\.com/\S+|\b(?:id|club)\d+\b"), "[vk]"),
+]
+
+
+def redact_text(text: str) -> str:
+    for pattern, replacement in PII_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class RequestLogger:
+    """
+    Фоновый журнал запросов: log() только кладёт запись в очередь и никогда
+    не ждёт диск. Раз в flush_interval секунд (или при накоплении batch_size записей)
+    пачка сжимается в отдельном потоке и дописывается в файл отдельным gzip-блоком.
+    Файл сменяется при превышении rotate_bytes, старые файлы сверх keep_files удаляются.
+    """
+
+    def __init__(self, directory: str, flush_interval: float, batch_size: int, max_queue: int,
+                 rotate_bytes: int, keep_files: int, redact: bool, secret: Optional[str] = None):
+        self.directory = Path(__file__).parent / directory
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.rotate_bytes = rotate_bytes
+        self.keep_files = keep_files
+        self.redact = redact
+        self._secret = secret.encode("utf-8") if secret else os.urandom(32)
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._path: Optional[Path] = None
+        self.logged = 0
+        self.dropped = 0
+        self.written = 0
+        self.files = 0
+        self.write_errors = 0
+
+    def log(self, record: dict):
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            REQUEST_LOG_RECORDS.labels(result="dropped").inc()
+            return
+        self._queue.append(record)
+        self.logged += 1
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def pseudonym(self, value: str) -> str:
+        """
+        Стабильная замена идентификатора (peer_id, id клиента): HMAC с секретом,
+        а не голый sha256 - короткие числовые id перебором не восстановить
+        """
+        return hmac.new(self._secret, value.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+    def redact_request(self, request: "DialogRequest") -> dict:
+        """
+        Запрос для журнала: авторы заменены на A0, A1..., текст без персональных данных.
+        Для запросов с сессией пишется вся история диалога, чтобы запись можно было
+        воспроизвести без состояния сервера (new_messages - сколько пришло в самом запросе)
+        """
+        authors: Dict[str, str] = {}
+        clean = redact_text if self.redact else (lambda text: text)
+        client = current_client.get() or ANONYMOUS_CLIENT
+        history = conversation_store.history(client, request.peer_id) if request.peer_id else None
+        messages = []
+        for msg in history or request.messages:
+            author = authors.setdefault(msg.author, f"A{len(authors)}") if self.redact else msg.author
+            messages.append({"author": author, "timestamp": msg.timestamp, "content": clean(msg.content), "id": msg.id})
+        return {
+            "messages": messages,
+            "context": clean(request.context),
+            "candidate_count": request.candidate_count,
+            "bypass_cache": request.bypass_cache,
+            "peer_id": self.pseudonym(request.peer_id) if request.peer_id else None,
+            "new_messages": len(request.messages),
+        }
+
+    def redact_reply(self, reply: Optional[str]) -> Optional[str]:
+        return redact_text(reply) if self.redact and reply else reply
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self._queue:
+            batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.batch_size))]
+            lines = b"".join(orjson.dumps(record) + b"\n" for record in batch)
+            try:
+                # Сжатие и запись - в отдельном потоке, event loop не ждёт диск
+                await asyncio.to_thread(self._write, lines)
+                self.written += len(batch)
+                REQUEST_LOG_RECORDS.labels(result="written").inc(len(batch))
+            except OSError as e:
+                self.write_errors += 1
+                REQUEST_LOG_RECORDS.labels(result="failed").inc(len(batch))
+                print(f"⚠️  Не удалось записать журнал запросов: {e}")
+
+    def _write(self, lines: bytes):
+        if self._path is None or (self._path.exists() and self._path.stat().st_size >= self.rotate_bytes):
+            self._rotate()
+        with open(self._path, "ab") as f:
+            f.write(gzip.compress(lines))
+
+    def _rotate(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # pid в имени: у каждого воркера свой файл
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self._path = self.directory / f"requests-{stamp}-{os.getpid()}-{self.files}.jsonl.gz"
+        self.files += 1
+        old_files = sorted(self.directory.glob("requests-*.jsonl.gz"), key=lambda path: path.stat().st_mtime)
+        for path in old_files[:max(len(old_files) - self.keep_files + 1, 0)]:
+            path.unlink(missing_ok=True)
+
+    def start(self):
+        """
+        Запускает фоновую запись. Вызывается из lifespan: задача, созданная внутри запроса,
+        унаследовала бы его контекст (тайминги, клиента, срок)
+        """
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "logged": self.logged,
+            "written": self.written,
+            "queued": len(self._queue),
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+            "file": self._path.name if self._path else None,
+        }
+
+
+request_logger = RequestLogger(
+    REQUEST_LOG_DIR, REQUEST_LOG_FLUSH_INTERVAL, REQUEST_LOG_BATCH_SIZE, REQUEST_LOG_MAX_QUEUE,
+    REQUEST_LOG_ROTATE_BYTES, REQUEST_LOG_KEEP_FILES, REQUEST_LOG_REDACT, REQUEST_LOG_SECRET
+) if REQUEST_LOG_ENABLED else None
+
+
+def log_exchange(path: str, request: "DialogRequest", started_at: float, status_code: int,
+                 response: Optional[dict] = None, error: Optional[str] = None):
+    """Записывает запрос и ответ в журнал (если он включён); не блокирует обработку"""
+    if request_logger is None:
+        return
+    timings = current_timings.get()
+    if response is not None:
+        response = {
+            **response,
+            "suggested_reply": request_logger.redact_reply(response.get("suggested_reply")),
+            "candidates": [request_logger.redact_reply(reply) for reply in response["candidates"]]
+                          if response.get("candidates") else None,
+        }
+    client = current_client.get() or ANONYMOUS_CLIENT
+    request_logger.log({
+        "ts": started_at,
+        "path": path,
+        # Имена ключей API пишутся как есть, установки и IP - только псевдонимом
+        "client": client.name if client.authenticated or client is ANONYMOUS_CLIENT
+                  else request_logger.pseudonym(client.id),
+        "priority": request_priority.get(),
+        "request": request_logger.redact_request(request),
+        "prompt_chars": timings.prompt_chars if timings else None,
+        "timings": {stage: round(seconds, 6) for stage, seconds in timings.stages.items()} if timings else None,
+        "status_code": status_code,
+        "response": response,
+        "error": error,
+        "duration": round(time.time() - started_at, 6),
+    })
+
+
+def prompt_version(prompt: str) -> str:
+    """Короткий хэш содержимого промпта - меняется при любом изменении текста"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+
+DEFAULT_SYSTEM_PROMPT = """Ты - умный ассистент для анализа диалогов и формирования ответов.
+
+ТВОЯ ЗАДАЧА:
+Проанализировать историю диалога с учётом временных меток и предложить уместный, естественный ответ.
+
+ВРЕМЕННОЙ КОНТЕКСТ:
+- Обращай внимание на время между сообщениями
+- Долгие паузы (несколько часов/дней) могут требовать более вежливого возобновления диалога
+- Быстрые ответы указывают на активную беседу
+- Если последнее сообщение было давно, учти это в тоне ответа
+
+ПРАВИЛА:
+- Отвечай на том же языке, что и диалог
+- Сохраняй тон и стиль беседы (формальный/неформальный)
+- Будь кратким и по существу
+- Отвечай на заданные вопросы
+- Не повторяй уже сказанное
+- Будь вежливым и естественным
+
+ФОРМАТ ОТВЕТА:
+Предложи только текст ответа, без дополнительных пояснений или комментариев."""
+
+PROMPT_BODY_PATTERN = re.compile(r'\{(.*?)\}', re.DOTALL)
+
+
+def parse_system_prompt(content: str) -> str:
+    """
+    Извлекает промпт из содержимого файла: только текст внутри фигурных скобок {}.
+    Всё остальное считается комментариями и игнорируется.
+    """
+    match = PROMPT_BODY_PATTERN.search(content)
+    
+    if match:
+        print(f"✅ Промпт извлечён из фигурных скобок")
+        return match.group(1).strip()
+    else:
+        print(f"⚠️  Фигурные скобки не найдены в файле. Используется весь файл как промпт.")
+        return content.strip()
+
+
+class PromptRegistry:
+    """
+    Версии системного промпта для нескольких воркеров.
+    
+    Все процессы следят за одним файлом: не чаще раза в check_interval секунд
+    сверяют его mtime и размер, а при изменении перечитывают. Версия - хэш
+    разобранного промпта, поэтому у всех воркеров она одинакова без общего
+    состояния. Каждое содержимое файла разбирается один раз, разобранные версии
+    хранятся, и возврат к прежнему тексту обходится без повторного разбора.
+    """
+
+    def __init__(self, prompt_file: str, check_interval: float, max_versions: int = 8):
+        self.prompt_file = prompt_file
+        self.path = Path(__file__).parent / prompt_file
+        self.check_interval = check_interval
+        self.max_versions = max_versions
+        self._file_stamp = None  # (mtime_ns, size) последнего прочитанного файла
+        self._next_check = 0.0
+        self._parsed: "OrderedDict[str, str]" = OrderedDict()  # хэш файла -> промпт
+        self.version = None
+        self.activated_at = None
+        self.checks = 0
+        self.parses = 0
+        self.switches = 0
+
+    def _stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self) -> Optional[str]:
+        try:
+            return self.path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Проверяет файл и при изменении активирует новую версию промпта.
+        Без force проверка выполняется не чаще раза в check_interval секунд.
+        Возвращает True, если активная версия сменилась.
+        """
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        self.checks += 1
+        
+        stamp = self._stamp()
+        if not force and self.version is not None and stamp == self._file_stamp:
+            return False
+        self._file_stamp = stamp
+        
+        content = self._read()
+        if content is None:
+            if self.version is None or force:
+                print(f"⚠️  Файл {self.prompt_file} не найден. Используется дефолтный промпт.")
+            return self._activate(DEFAULT_SYSTEM_PROMPT)
+        
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        prompt = self._parsed.get(content_hash)
+        if prompt is None:
+            prompt = parse_system_prompt(content)
+            self.parses += 1
+            self._parsed[content_hash] = prompt
+            while len(self._parsed) > self.max_versions:
+                self._parsed.popitem(last=False)
+        else:
+            self._parsed.move_to_end(content_hash)
+        return self._activate(prompt)
+
+    def _activate(self, prompt: str) -> bool:
+        global SYSTEM_PROMPT, SYSTEM_PROMPT_VERSION
+        version = prompt_version(prompt)
+        if version == self.version:
+            return False
+        
+        # Обе переменные меняются без await между ними - запросы видят согласованную пару
+        SYSTEM_PROMPT, SYSTEM_PROMPT_VERSION = prompt, version
+        if self.version is not None:
+            print(f"🔄 Системный промпт обновлён: {self.version} → {version}")
+        self.version = version
+        self.activated_at = datetime.now()
+        self.switches += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "version": SYSTEM_PROMPT_VERSION,
+            "activated_at": self.activated_at.isoformat(timespec="seconds") if self.activated_at else None,
+            "check_interval": self.check_interval,
+            "checks": self.checks,
+            "parses": self.parses,
+            "switches": self.switches,
+            "cached_versions": len(self._parsed),
+            "pid": os.getpid(),
+        }
+
+
+prompt_registry = PromptRegistry(PROMPT_FILE, PROMPT_CHECK_INTERVAL)
+
+
+# Ход холодного старта: отдаётся в GET /ready и GET /
+startup_stats = {
+    "ready": False,
+    "import_seconds": None,
+    "startup_seconds": None,
+    "warmup_seconds": None,
+    "warmup": {},  # маршрут LLM -> "ok" или текст ошибки прогрева
+}
+warmup_task: Optional[asyncio.Task] = None
+
+
+def record_startup_phase(phase: str, seconds: float):
+    startup_stats[f"{phase}_seconds"] = round(seconds, 4)
+    STARTUP_SECONDS.labels(phase=phase).set(seconds)
+
+
+async def warm_up_route(route: "LLMRoute"):
+    """Создаёт клиента маршрута и заранее открывает соединение с его endpoint"""
+    # Импорт SDK и создание клиента - синхронные, выполняем их вне event loop
+    client = await asyncio.to_thread(lambda: route.client)
+    if STARTUP_WARM_CONNECTIONS:
+        # Запрос метаданных модели не тратит токены, но устанавливает TLS-соединение в пуле клиента
+        await asyncio.wait_for(client.aio.models.get(model=route.model), STARTUP_WARMUP_TIMEOUT)
+    if STARTUP_WARMUP_CALL:
+        await asyncio.wait_for(
+            client.aio.models.generate_content(model=route.model, contents="Ответь одним словом: готов"),
+            STARTUP_WARMUP_TIMEOUT
+        )
+
+
+async def warm_up():
+    """
+    Фоновый прогрев после старта. Пока он идёт, /ready отвечает 503, но запросы
+    уже обслуживаются (клиент LLM при необходимости создастся по первому запросу).
+    Ошибка прогрева не мешает готовности - доступность LLM отслеживает circuit breaker.
+    """
+    started = time.perf_counter()
+    
+    async def warm(route: "LLMRoute"):
+        try:
+            await warm_up_route(route)
+            startup_stats["warmup"][route.label] = "ok"
+        except Exception as e:
+            startup_stats["warmup"][route.label] = f"{type(e).__name__}: {e}"
+            print(f"⚠️  Прогрев {route.label} не удался: {e}")
+    
+    await asyncio.gather(*[warm(route) for route in llm_router.routes])
+    record_startup_phase("warmup", time.perf_counter() - started)
+    startup_stats["ready"] = True
+    print(f"🔥 Прогрев завершён за {startup_stats['warmup_seconds']} с, воркер готов принимать трафик")
+
+
+async def startup_event():
+    global warmup_task
+    started = time.perf_counter()
+    prompt_registry.refresh(force=True)
+    print(f"✅ Системный промпт загружен (версия {SYSTEM_PROMPT_VERSION})")
+    print(f"📝 Длина промпта: {len(SYSTEM_PROMPT)} символов")
+    print(f"🤖 Модель: {MODEL_NAME}")
+    if USE_CUSTOM_ENDPOINT:
+        print(f"🔗 Custom API endpoint: {CUSTOM_API_URL}")
+    else:
+        print(f"🔗 Standard Google API endpoint")
+    if request_logger is not None:
+        request_logger.start()
+        print(f"🗒️  Журнал запросов: {request_logger.directory}")
+    prefetch_queue.start()
+    
+    record_startup_phase("startup", time.perf_counter() - started)
+    print(f"⏱️  Импорт: {startup_stats['import_seconds']} с, запуск: {startup_stats['startup_seconds']} с")
+    warmup_task = asyncio.ensure_future(warm_up())
+
+
+async def shutdown_event():
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await prefetch_queue.stop()
+    # Дописываем накопленные записи журнала, чтобы не потерять хвост
+    if request_logger is not None:
+        await request_logger.close()
+    for client in (genai_client, hedge_genai_client):
+        if client is not None and hasattr(client.aio, "aclose"):
+            await client.aio.aclose()
+
+
+class Message(BaseModel):
+    """Модель одного сообщения в диалоге"""
+    author: str  # Кто написал
+    timestamp: Union[int, float, str]  # Когда написал (epoch-секунды, ISO или строка)
+    content: str  # Что написал
+    id: Optional[str] = None  # id сообщения VK (data-msgid), нужен для сессий
+
+
+class DialogRequest(BaseModel):
+    """Модель запроса с диалогом"""
+    messages: List[Message]
+    context: str = ""  # Дополнительный контекст (опционально)
+    bypass_cache: bool = False  # Не брать ответ из кэша (ответ всё равно сохранится в кэш)
+    include_timings: bool = False  # Вернуть в ответе время этапов обработки
+    # Серверная сессия: с peer_id в messages передаются только новые сообщения
+    peer_id: Optional[str] = None  # id диалога VK (data-peer)
+    base_message_id: Optional[str] = None  # последний id, уже отправленный на сервер
+    reset_session: bool = False  # messages - вся история, старая сессия отбрасывается
+    candidate_count: int = 1  # Сколько вариантов ответа вернуть (не больше CANDIDATES_MAX)
+
+
+class DialogResponse(BaseModel):
+    """Модель ответа с предложенным текстом"""
+    suggested_reply: str
+    processing_time: float
+    cached: bool = False  # Ответ взят из кэша без вызова LLM
+    session_last_message_id: Optional[str] = None  # Последний id в серверной сессии
+    tokens_saved: int = 0  # Сколько токенов истории сэкономило краткое содержание
+    timings: Optional[Dict[str, float]] = None  # Время этапов (если include_timings)
+    prompt_version: Optional[str] = None  # Версия системного промпта, с которой получен ответ
+    candidates: Optional[List[str]] = None  # Варианты от лучшего к худшему (если candidate_count > 1)
+    retrieved: bool = False  # Ответ взят из индекса принятых ответов без вызова LLM
+    similarity: Optional[float] = None  # Близость к найденному в индексе вопросу
+
+
+class BatchDialogRequest(BaseModel):
+    """Модель пакетного запроса: несколько диалогов сразу"""
+    requests: List[DialogRequest]
+    max_parallel: Optional[int] = None  # Не больше BATCH_MAX_PARALLEL
+
+
+class BatchItemResult(BaseModel):
+    """Результат одного диалога из пакета"""
+    index: int  # Позиция диалога в запросе
+    ok: bool
+    result: Optional[DialogResponse] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+
+
+class PrefetchResponse(BaseModel):
+    """Состояние упреждающей генерации для диалога"""
+    status: str  # queued, running, ready, stale или missing
+    last_message_id: Optional[str] = None  # Сообщение, на которое готовится ответ
+    suggested_reply: Optional[str] = None  # Есть только в статусе ready
+    candidates: Optional[List[str]] = None
+    prompt_version: Optional[str] = None
+    age: Optional[float] = None  # Сколько секунд назад ответ был готов
+
+
+class AcceptedReply(BaseModel):
+    """Ответ, который оператор скопировал и отправил клиенту"""
+    messages: List[Message]  # Последние сообщения диалога, на которые дан ответ
+    reply: str
+
+
+class BatchDialogResponse(BaseModel):
+    """Модель ответа на пакетный запрос (результаты в порядке запроса)"""
+    results: List[BatchItemResult]
+    processing_time: float
+
+
+@app.get("/")
+async def root():
+    """Проверка работоспособности API"""
+    return {
+        "status": "ok",
+        "service": "Respondo Backend",
+        "version": "2.1.0",
+        "prompt_loaded": SYSTEM_PROMPT is not None,
+        "model": MODEL_NAME,
+        "endpoint_type": "custom" if USE_CUSTOM_ENDPOINT else "standard",
+        "api_endpoint": CUSTOM_API_URL if USE_CUSTOM_ENDPOINT else "api.google.com",
+        "llm_queue": llm_limiter.stats(),
+        "response_cache": response_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "stream_flight": stream_flight.stats(),
+        "sessions": conversation_store.stats(),
+        "context_window": {
+            **context_window_stats,
+            "token_budget": PROMPT_HISTORY_TOKEN_BUDGET,
+            "summary_cache": summary_cache.stats()
+        },
+        "timestamps": timestamp_stats,
+        "hedging": llm_router.stats(),
+        "prompt": prompt_registry.stats(),
+        "prefetch": prefetch_queue.stats(),
+        "clients": client_registry.stats(),
+        "reply_index": reply_index.stats() if reply_index else {"enabled": False},
+        "request_log": request_logger.stats() if request_logger else {"enabled": False},
+        "startup": startup_stats
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/health")
+async def health_check(response: Response):
+    """
+    Health check endpoint
+    
+    Если circuit breaker разомкнут у всех маршрутов LLM, отвечает 503,
+    чтобы балансировщик вывел воркер из ротации
+    """
+    breakers = {route.label: route.breaker.stats() for route in llm_router.routes}
+    healthy = any(not route.breaker.is_open for route in llm_router.routes)
+    if not healthy:
+        response.status_code = 503
+    return {
+        "status": "healthy" if healthy else "unhealthy",
+        "circuit_breakers": breakers
+    }
+
+
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """
+    Readiness probe: 200, когда воркер загрузил промпт и прогрел клиентов LLM
+    
+    В отличие от /health (жив ли воркер и доступна ли LLM), пока идёт прогрев
+    отвечает 503, чтобы балансировщик не направлял трафик на холодную реплику
+    """
+    ready = startup_stats["ready"] and SYSTEM_PROMPT is not None
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "starting", **startup_stats}
+
+
+@app.post("/reload-prompt")
+async def reload_prompt():
+    """
+    Перезагружает системный промпт из файла без перезапуска сервера
+    
+    Остальные воркеры сами заметят изменение файла в течение PROMPT_CHECK_INTERVAL секунд
+    """
+    changed = prompt_registry.refresh(force=True)
+    return {
+        "status": "success",
+        "message": "Промпт перезагружен" if changed else "Промпт не изменился",
+        "prompt_length": len(SYSTEM_PROMPT),
+        "prompt_version": SYSTEM_PROMPT_VERSION
+    }
+
+
+@app.delete("/api/sessions/{peer_id}")
+async def drop_session(peer_id: str):
+    """
+    Удаляет серверную сессию диалога текущего клиента (следующий запрос начнёт её заново)
+    """
+    client = client_registry.admit()
+    return {"status": "success", "dropped": conversation_store.drop(client, peer_id)}
+
+
+def resolve_session(request: DialogRequest) -> DialogRequest:
+    """
+    Если в запросе есть peer_id, дополняет серверную сессию новыми сообщениями
+    и возвращает запрос с полной историей диалога
+    """
+    if not request.peer_id:
+        return request
+    
+    if any(msg.id is None for msg in request.messages):
+        raise HTTPException(
+            status_code=400,
+            detail="Для работы с сессией у каждого сообщения должен быть id"
+        )
+    
+    session = conversation_store.sync(
+        current_client.get() or ANONYMOUS_CLIENT,
+        request.peer_id,
+        request.messages,
+        request.base_message_id,
+        reset=request.reset_session
+    )
+    return request.model_copy(update={"messages": list(session.messages.values())})
+
+
+def session_last_message_id(request: DialogRequest) -> Optional[str]:
+    """id последнего сообщения, которое сервер знает по этому диалогу"""
+    if not request.peer_id or not request.messages:
+        return None
+    return request.messages[-1].id
+
+
+async def generate_reply(request: DialogRequest) -> DialogResponse:
+    """
+    Полный цикл получения ответа на один диалог: сессия, кэш, промпт и вызов LLM
+    """
+    start_time = datetime.now()
+    request = resolve_session(request)
+    prompt_registry.refresh()
+    version = SYSTEM_PROMPT_VERSION
+    candidate_count = requested_candidates(request)
+    
+    # Одинаковый диалог в пределах TTL отдаём из кэша без вызова LLM
+    # (в кэше хранится список вариантов, первый - лучший)
+    cache_key = build_cache_key(request, start_time)
+    if not request.bypass_cache:
+        cached_replies = response_cache.get(cache_key)
+        if cached_replies is not None:
+            return DialogResponse(
+                suggested_reply=cached_replies[0],
+                candidates=cached_replies if candidate_count > 1 else None,
+                processing_time=(datetime.now() - start_time).total_seconds(),
+                cached=True,
+                session_last_message_id=session_last_message_id(request),
+                timings=timings_snapshot() if request.include_timings else None,
+                prompt_version=version
+            )
+    
+    # На похожий вопрос уже есть принятый оператором ответ - вызывать LLM не нужно
+    found = search_reply_index(request, candidate_count)
+    if found:
+        replies = [reply for _, reply in found]
+        return DialogResponse(
+            suggested_reply=replies[0],
+            candidates=replies if candidate_count > 1 else None,
+            processing_time=(datetime.now() - start_time).total_seconds(),
+            session_last_message_id=session_last_message_id(request),
+            timings=timings_snapshot() if request.include_timings else None,
+            prompt_version=version,
+            retrieved=True,
+            similarity=found[0][0]
+        )
+    
+    # Формируем промпт для LLM из истории диалога с временными метками
+    with timed_stage("format"):
+        dialog_text, tokens_saved = await build_dialog_prompt(request.messages, start_time)
+    
+    async def generate_and_cache() -> List[str]:
+        replies = await call_llm_candidates(dialog_text, request.context, start_time, candidate_count)
+        # Если промпт сменился во время вызова, ответ под ключом старой версии не кэшируем
+        if SYSTEM_PROMPT_VERSION == version:
+            response_cache.set(cache_key, replies)
+        return replies
+    
+    # Одинаковые запросы, пришедшие одновременно, ждут один общий вызов LLM
+    replies = await single_flight.do(cache_key, generate_and_cache)
+    
+    processing_time = (datetime.now() - start_time).total_seconds()
+    
+    return DialogResponse(
+        suggested_reply=replies[0],
+        candidates=replies if candidate_count > 1 else None,
+        processing_time=processing_time,
+        session_last_message_id=session_last_message_id(request),
+        tokens_saved=tokens_saved,
+        timings=timings_snapshot() if request.include_timings else None,
+        prompt_version=version
+    )
+
+
+def search_reply_index(request: DialogRequest, candidate_count: int) -> List[Tuple[float, str]]:
+    """Принятые ранее ответы на похожий хвост диалога (пусто, если индекс выключен)"""
+    if reply_index is None or request.bypass_cache or not request.messages:
+        return []
+    with timed_stage("retrieval"):
+        return reply_index.search(current_client.get() or ANONYMOUS_CLIENT, request.messages, candidate_count)
+
+
+def timings_snapshot() -> Optional[Dict[str, float]]:
+    """Копия таймингов текущего запроса (в секундах) для тела ответа"""
+    timings = current_timings.get()
+    if timings is None:
+        return None
+    return {stage: round(seconds, 6) for stage, seconds in timings.stages.items()}
+
+
+@app.post("/api/suggest-reply", response_model=DialogResponse)
+async def suggest_reply(request: DialogRequest, http_request: Request):
+    """
+    Основной endpoint для получения предложенного ответа на диалог
+    
+    Принимает диалог, отправляет в LLM и возвращает предложенный ответ
+    """
+    client_registry.admit()
+    started_at = time.time()
+    try:
+        # Если клиент отключится раньше, вызов LLM будет отменён
+        response = await run_until_disconnect(http_request, generate_reply(request))
+    
+    except HTTPException as e:
+        log_exchange("/api/suggest-reply", request, started_at, e.status_code, error=str(e.detail))
+        raise
+    except Exception as e:
+        log_exchange("/api/suggest-reply", request, started_at, 500, error=str(e))
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка при обработке запроса: {str(e)}"
+        )
+    
+    log_exchange("/api/suggest-reply", request, started_at, 200,
+                 response=response.model_dump(exclude={"timings"}))
+    return response
+
+
+@app.post("/api/suggest-reply/stream")
+async def suggest_reply_stream(request: DialogRequest):
+    """
+    Потоковый вариант /api/suggest-reply (server-sent events)
+    
+    События:
+    - token: очередной фрагмент ответа {"text": ...}
+    - done: итог {"suggested_reply", "first_token_time", "processing_time", "cached",
+      "session_last_message_id", "tokens_saved", "prompt_version", "candidates", "retrieved", "similarity"}
+    - error: ошибка во время генерации {"detail": ..., "status_code": ...}
+      (504 - LLM не прислала очередной фрагмент вовремя или истёк срок запроса)
+    
+    При candidate_count > 1 потоком идёт первый вариант, а остальные параллельно
+    запрашиваются обычным вызовом и приходят в событии done.
+    Одинаковые одновременные запросы получают фрагменты одного и того же вызова LLM
+    """
+    client_registry.admit()
+    started_at = time.time()
+    start_time = datetime.now()
+    # Тело потока выполняется уже после выхода из обработчика - сохраняем данные запроса для него
+    timings = current_timings.get()
+    client = current_client.get()
+    deadline = request_deadline.get()
+    if request.peer_id:
+        # Ответ генерируется сейчас - фоновая генерация для этого диалога стала лишней
+        prefetch_queue.discard(client or ANONYMOUS_CLIENT, request.peer_id)
+    # В журнал - запрос, как его прислал клиент (new_messages), а не вся история сессии
+    received = request
+    request = resolve_session(request)
+    last_message_id = session_last_message_id(request)
+    prompt_registry.refresh()
+    version = SYSTEM_PROMPT_VERSION
+    
+    candidate_count = requested_candidates(request)
+    cache_key = build_cache_key(request, start_time)
+    cached_replies = None if request.bypass_cache else response_cache.get(cache_key)
+    found = search_reply_index(request, candidate_count) if cached_replies is None else []
+    instant_replies = cached_replies or [reply for _, reply in found] or None
+    if instant_replies is not None:
+        # Ответ из кэша или индекса принятых ответов отдаём одним токеном
+        async def cached_stream():
+            current_timings.set(timings)
+            current_client.set(client)
+            elapsed = (datetime.now() - start_time).total_seconds()
+            done = {
+                "suggested_reply": instant_replies[0],
+                "candidates": instant_replies if candidate_count > 1 else None,
+                "first_token_time": elapsed,
+                "processing_time": elapsed,
+                "cached": cached_replies is not None,
+                "retrieved": bool(found),
+                "similarity": found[0][0] if found else None,
+                "session_last_message_id": last_message_id,
+                "tokens_saved": 0,
+                "prompt_version": version
+            }
+            yield format_sse("token", {"text": instant_replies[0]})
+            yield format_sse("done", done)
+            log_exchange("/api/suggest-reply/stream", received, started_at, 200, response=done)
+        
+        return StreamingResponse(cached_stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
+    
+    # Такой же запрос уже генерируется потоком (двойной клик, несколько вкладок) - подписываемся на него
+    flight = stream_flight.join(cache_key)
+    if flight is None:
+        flight = await start_stream_flight(cache_key, request, start_time, candidate_count, version)
+    stream_flight.subscribe(flight)
+    
+    async def event_stream():
+        current_timings.set(timings)
+        current_client.set(client)
+        request_deadline.set(deadline)
+        first_token_time = None
+        try:
+            async for text in flight.tokens():
+                if first_token_time is None:
+                    first_token_time = (datetime.now() - start_time).total_seconds()
+                yield format_sse("token", {"text": text})
+            
+            # Подписчик мог уйти со скоростью потока - задача уже завершена
+            replies = await asyncio.shield(flight.task)
+            done = {
+                "suggested_reply": replies[0],
+                "candidates": replies if candidate_count > 1 else None,
+                "first_token_time": first_token_time,
+                "processing_time": (datetime.now() - start_time).total_seconds(),
+                "cached": False,
+                "session_last_message_id": last_message_id,
+                "tokens_saved": flight.tokens_saved,
+                "prompt_version": version
+            }
+            yield format_sse("done", done)
+            log_exchange("/api/suggest-reply/stream", received, started_at, 200, response=done)
+        except HTTPException as e:
+            # Истёк срок запроса - breaker не трогаем
+            log_exchange("/api/suggest-reply/stream", received, started_at, e.status_code, error=str(e.detail))
+            yield format_sse("error", {"detail": e.detail, "status_code": e.status_code})
+        except asyncio.TimeoutError:
+            detail = "Gemini API не ответил за отведённое время"
+            log_exchange("/api/suggest-reply/stream", received, started_at, 504, error=detail)
+            yield format_sse("error", {"detail": detail, "status_code": 504})
+        except Exception as e:
+            log_exchange("/api/suggest-reply/stream", received, started_at, 500, error=str(e))
+            yield format_sse("error", {"detail": f"Ошибка при вызове Gemini API: {str(e)}", "status_code": 500})
+        finally:
+            stream_flight.unsubscribe(cache_key, flight)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def start_stream_flight(cache_key: str, request: DialogRequest, start_time: datetime,
+                              candidate_count: int, version: str) -> StreamFlight:
+    """
+    Начинает потоковый вызов LLM для suggest_reply_stream. Разомкнутый breaker и перегрузка
+    возвращаются обычным 503 ещё до начала ответа; сам вызов идёт в фоновой задаче,
+    чтобы на него могли подписаться одинаковые запросы
+    """
+    with timed_stage("format"):
+        dialog_text, tokens_saved = await build_dialog_prompt(request.messages, start_time)
+    
+    breaker = llm_router.primary.breaker
+    if not breaker.allow_request():
+        raise llm_router.primary.unavailable()
+    stack = AsyncExitStack()
+    stack.callback(breaker.release_probe)
+    # Слот потока освобождается отдельно, как только поток закончился: дополнительные
+    # варианты ждут своего слота, и держать свой, ожидая их, нельзя - при полной очереди
+    # варианты не дождались бы слота никогда
+    slot = AsyncExitStack()
+    stack.push_async_callback(slot.aclose)
+    try:
+        await slot.enter_async_context(llm_limiter.slot())
+    except BaseException:
+        # Задача вызова не создана, и её finally не сработает - иначе проба
+        # half-open так и осталась бы занятой, а breaker - полуоткрытым навсегда
+        await stack.aclose()
+        raise
+    
+    # Остальные варианты запрашиваем параллельно с потоком
+    alternatives_task = None
+    if candidate_count > 1:
+        alternatives_task = asyncio.ensure_future(
+            call_llm_candidates(dialog_text, request.context, start_time, candidate_count - 1)
+        )
+        stack.callback(alternatives_task.cancel)
+    
+    async def generate(flight: StreamFlight) -> List[str]:
+        # Задача создана внутри обработчика и работает с его таймингами, клиентом и сроком
+        try:
+            # Поток через роутер: медленный первый токен основной модели хеджируется,
+            # а итог вызова роутер сам записывает в circuit breaker маршрута
+            async for text in llm_router.stream(dialog_text, request.context, start_time):
+                flight.publish(text)
+            
+            await slot.aclose()
+            replies = ["".join(flight.parts).strip()]
+            if alternatives_task is not None:
+                try:
+                    alternatives = await alternatives_task
+                except Exception as e:
+                    # Без дополнительных вариантов ответ всё равно полезен
+                    print(f"⚠️  Не удалось получить дополнительные варианты: {e}")
+                    alternatives = []
+                replies = rank_candidates(replies + alternatives, candidate_count)
+            
+            if SYSTEM_PROMPT_VERSION == version:
+                response_cache.set(cache_key, replies)
+            return replies
+        except HTTPException:
+            raise
+        except asyncio.TimeoutError:
+            UPSTREAM_ERRORS.labels(error="TimeoutError").inc()
+            raise
+        except Exception as e:
+            UPSTREAM_ERRORS.labels(error=type(e).__name__).inc()
+            raise
+        finally:
+            await stack.aclose()
+    
+    flight = stream_flight.start(cache_key, generate)
+    flight.tokens_saved = tokens_saved
+    return flight
+
+
+def start_batch(batch: BatchDialogRequest) -> List[asyncio.Task]:
+    """
+    Запускает обработку всех диалогов пакета; одновременно выполняется
+    не больше max_parallel из них
+    """
+    if len(batch.requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Слишком много диалогов в пакете (максимум {BATCH_MAX_ITEMS})"
+        )
+    
+    # Первый диалог проверяется как обычный запрос (401/429), остальные списываются
+    # с лимита клиента по мере запуска - иначе пакет больше burst не прошёл бы никогда
+    client_registry.admit()
+    
+    max_parallel = min(batch.max_parallel or BATCH_MAX_PARALLEL, BATCH_MAX_PARALLEL)
+    semaphore = asyncio.Semaphore(max(max_parallel, 1))
+    
+    async def run_item(index: int, request: DialogRequest) -> BatchItemResult:
+        async with semaphore:
+            if index > 0:
+                await client_registry.throttle()
+            # У каждого диалога свой срок, отсчитываемый от начала его обработки
+            start_deadline()
+            request_priority.set(PRIORITY_BATCH)
+            try:
+                result = await generate_reply(request)
+                return BatchItemResult(index=index, ok=True, result=result)
+            except HTTPException as e:
+                return BatchItemResult(index=index, ok=False, error=str(e.detail), status_code=e.status_code)
+            except Exception as e:
+                return BatchItemResult(index=index, ok=False, error=str(e), status_code=500)
+    
+    return [asyncio.ensure_future(run_item(i, request)) for i, request in enumerate(batch.requests)]
+
+
+@app.post("/api/suggest-reply/batch", response_model=BatchDialogResponse)
+async def suggest_reply_batch(batch: BatchDialogRequest, http_request: Request):
+    """
+    Пакетный endpoint: ответы на несколько диалогов за один HTTP-запрос
+    
+    Ошибка в одном диалоге не прерывает пакет - она возвращается в его результате
+    """
+    start_time = datetime.now()
+    tasks = start_batch(batch)
+    results = await run_until_disconnect(http_request, asyncio.gather(*tasks))
+    
+    return BatchDialogResponse(
+        results=results,
+        processing_time=(datetime.now() - start_time).total_seconds()
+    )
+
+
+@app.post("/api/suggest-reply/batch/stream")
+async def suggest_reply_batch_stream(batch: BatchDialogRequest):
+    """
+    Потоковый вариант пакетного endpoint (NDJSON)
+    
+    Каждая строка - BatchItemResult; строки идут по мере готовности, а не по порядку
+    """
+    tasks = start_batch(batch)
+    
+    async def result_lines():
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                item = await next_result
+                yield item.model_dump_json() + "\n"
+        finally:
+            # Клиент отключился - незавершённые диалоги больше не нужны
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(result_lines(), media_type="application/x-ndjson")
+
+
+class PrefetchQueue:
+    """
+    Упреждающая генерация ответов: content script присылает диалог, как только
+    приходит новое входящее сообщение, а popup потом забирает готовый ответ.
+    
+    - На каждый диалог (клиент и peer_id) в очереди и в работе не больше одной задачи:
+      новое сообщение отменяет устаревшую генерацию
+    - Очередь ограничена: при переполнении вытесняется самый старый диалог
+    - Фоновые обработчики берут задачу, только когда у LLM остаётся больше
+      reserved_slots свободных слотов, то есть уступают интерактивным запросам
+    """
+
+    def __init__(self, max_queue: int, workers: int, reserved_slots: int,
+                 result_ttl: float, max_results: int):
+        self.max_queue = max_queue
+        self.workers = workers
+        self.reserved_slots = reserved_slots
+        self.result_ttl = result_ttl
+        self.max_results = max_results
+        # Ключ - (id клиента, peer_id): у разных операторов одного сообщества ответы свои
+        self._queue: "OrderedDict[Tuple[str, str], Tuple[ClientInfo, DialogRequest]]" = OrderedDict()
+        self._running: Dict[Tuple[str, str], Tuple[str, asyncio.Task]] = {}  # -> (id сообщения, задача)
+        self._results: "OrderedDict[Tuple[str, str], Tuple[str, DialogResponse, float]]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._worker_tasks: List[asyncio.Task] = []
+        self.enqueued = 0
+        self.dropped = 0
+        self.cancelled = 0
+        self.completed = 0
+        self.failed = 0
+        self.hits = 0
+        self.misses = 0
+
+    def submit(self, client: ClientInfo, request: DialogRequest) -> str:
+        """Ставит диалог в очередь, отменяя устаревшую задачу по этому же диалогу"""
+        key = (client.id, request.peer_id)
+        last_message_id = request.messages[-1].id
+        
+        running = self._running.get(key)
+        if running is not None:
+            if running[0] == last_message_id:
+                return "running"
+            running[1].cancel()
+            self.cancelled += 1
+        
+        result = self._results.get(key)
+        if result is not None and result[0] == last_message_id:
+            return "ready"
+        
+        if key in self._queue:
+            self.cancelled += 1
+            del self._queue[key]
+        elif len(self._queue) >= self.max_queue:
+            self._queue.popitem(last=False)
+            self.dropped += 1
+        
+        self._queue[key] = (client, request)
+        self.enqueued += 1
+        self._wakeup.set()
+        return "queued"
+
+    def lookup(self, client: ClientInfo, peer_id: str, last_message_id: Optional[str]) -> PrefetchResponse:
+        """Готовый ответ для диалога, если он подготовлен к этому же последнему сообщению"""
+        key = (client.id, peer_id)
+        result = self._results.get(key)
+        if result is not None and time.monotonic() - result[2] > self.result_ttl:
+            del self._results[key]
+            result = None
+        
+        if result is not None and (last_message_id is None or result[0] == last_message_id):
+            self.hits += 1
+            message_id, response, ready_at = result
+            return PrefetchResponse(
+                status="ready",
+                last_message_id=message_id,
+                suggested_reply=response.suggested_reply,
+                candidates=response.candidates,
+                prompt_version=response.prompt_version,
+                age=round(time.monotonic() - ready_at, 3)
+            )
+        
+        self.misses += 1
+        if key in self._running:
+            return PrefetchResponse(status="running", last_message_id=self._running[key][0])
+        if key in self._queue:
+            return PrefetchResponse(status="queued", last_message_id=self._queue[key][1].messages[-1].id)
+        if result is not None:
+            return PrefetchResponse(status="stale", last_message_id=result[0])
+        return PrefetchResponse(status="missing")
+
+    async def wait_running(self, client: ClientInfo, peer_id: str, last_message_id: Optional[str], timeout: float):
+        """
+        Ждёт (не дольше timeout) уже идущую генерацию к этому же сообщению,
+        чтобы popup не запускал второй вызов LLM ради того же ответа
+        """
+        key = (client.id, peer_id)
+        running = self._running.get(key)
+        if running is None or (last_message_id is not None and running[0] != last_message_id):
+            return
+        message_id, task = running
+        await asyncio.wait({task}, timeout=timeout)
+        # Результат сохраняем сами: обработчик мог ещё не успеть после завершения задачи
+        if task.done() and not task.cancelled() and task.exception() is None:
+            self._store(key, message_id, task.result())
+
+    def discard(self, client: ClientInfo, peer_id: str):
+        """Оператор сам запросил ответ для диалога - фоновая генерация для него больше не нужна"""
+        key = (client.id, peer_id)
+        if self._queue.pop(key, None) is not None:
+            self.cancelled += 1
+        running = self._running.get(key)
+        if running is not None and not running[1].done():
+            running[1].cancel()
+            self.cancelled += 1
+
+    def _store(self, key: Tuple[str, str], last_message_id: str, response: DialogResponse):
+        if self._results.get(key, (None,))[0] == last_message_id:
+            return
+        self._results[key] = (last_message_id, response, time.monotonic())
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+    def start(self):
+        """
+        Запускает фоновые обработчики. Вызывается из lifespan: обработчик, созданный внутри
+        запроса, унаследовал бы его контекст и записывал бы этапы prefetch в его тайминги
+        """
+        self._worker_tasks = [task for task in self._worker_tasks if not task.done()]
+        while len(self._worker_tasks) < self.workers:
+            self._worker_tasks.append(asyncio.ensure_future(self._worker()))
+
+    async def stop(self):
+        tasks = self._worker_tasks + [task for _, task in self._running.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    async def _worker(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            
+            # Интерактивные запросы важнее: ждём, пока у LLM не освободится запас слотов
+            if llm_limiter.free_slots() <= self.reserved_slots:
+                await asyncio.sleep(0.1)
+                continue
+            
+            key, (client, request) = self._queue.popitem(last=False)
+            last_message_id = request.messages[-1].id
+            task = asyncio.ensure_future(self._generate(client, request))
+            self._running[key] = (last_message_id, task)
+            try:
+                # wait, а не await: отмена устаревшей задачи не должна остановить обработчик
+                await asyncio.wait({task})
+            finally:
+                if self._running.get(key, (None, None))[1] is task:
+                    del self._running[key]
+            
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                self.failed += 1
+                print(f"⚠️  Prefetch для диалога {request.peer_id} не удался: {task.exception()}")
+                continue
+            
+            self.completed += 1
+            self._store(key, last_message_id, task.result())
+
+    async def _generate(self, client: ClientInfo, request: DialogRequest) -> DialogResponse:
+        # Обработчик работает вне HTTP-запроса: клиента и приоритет задаём сами
+        current_client.set(client)
+        request_priority.set(PRIORITY_PREFETCH)
+        start_deadline()
+        # Серверную сессию не трогаем: её подтверждения хранит popup
+        return await generate_reply(request.model_copy(update={
+            "peer_id": None,
+            "base_message_id": None,
+            "reset_session": False
+        }))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "queued": len(self._queue),
+            "running": len(self._running),
+            "ready": len(self._results),
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "cancelled": self.cancelled,
+            "completed": self.completed,
+            "failed": self.failed,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+prefetch_queue = PrefetchQueue(PREFETCH_MAX_QUEUE, PREFETCH_WORKERS, PREFETCH_RESERVED_SLOTS,
+                               PREFETCH_RESULT_TTL, PREFETCH_MAX_RESULTS)
+
+
+@app.post("/api/prefetch", status_code=202, response_model=PrefetchResponse)
+async def prefetch_reply(request: DialogRequest):
+    """
+    Упреждающая генерация: ставит диалог в фоновую очередь с низким приоритетом
+    
+    Нужны peer_id и id у сообщений (передаётся вся история, без серверной сессии).
+    Готовый ответ забирается через GET /api/prefetch/{peer_id}
+    """
+    if not request.peer_id or not request.messages or any(msg.id is None for msg in request.messages):
+        raise HTTPException(
+            status_code=400,
+            detail="Для prefetch нужны peer_id и id у каждого сообщения"
+        )
+    
+    client = client_registry.admit()
+    status = prefetch_queue.submit(client, request)
+    return PrefetchResponse(status=status, last_message_id=request.messages[-1].id)
+
+
+@app.get("/api/prefetch/{peer_id}", response_model=PrefetchResponse)
+async def get_prefetched_reply(peer_id: str, last_message_id: Optional[str] = None, wait: float = 0.0):
+    """
+    Готовый ответ упреждающей генерации
+    
+    Статус ready возвращается, только если ответ готовился к сообщению last_message_id.
+    С wait > 0 идущая генерация к этому сообщению дожидается (не дольше PREFETCH_MAX_WAIT секунд)
+    """
+    client = current_client.get() or ANONYMOUS_CLIENT
+    if wait > 0:
+        await prefetch_queue.wait_running(client, peer_id, last_message_id, min(wait, PREFETCH_MAX_WAIT))
+    return prefetch_queue.lookup(client, peer_id, last_message_id)
 
-ФОРМАТ ОТВЕТА:
-Предложи только текст ответа, без дополнительных пояснений или комментариев."""
 
+@app.post("/api/replies/accepted")
+async def accept_reply(accepted: AcceptedReply):
+    """
+    Сохраняет принятый оператором ответ в индекс: на похожий вопрос
+    сервер ответит им сразу, без вызова LLM
+    """
+    # Ответы из индекса отдаются операторам без проверки - писать в него могут только
+    # допущенные клиенты и не чаще их лимита
+    client = client_registry.admit()
+    if reply_index is None:
+        return {"status": "disabled"}
+    if not accepted.messages or not accepted.reply.strip():
+        raise HTTPException(status_code=400, detail="Нужны сообщения диалога и непустой ответ")
+    if not reply_index.eligible(accepted.messages):
+        # Ответ на реплику оператора или на "ок" без контекста повторять нельзя
+        return {"status": "skipped", "entries": reply_index.stats()["entries"]}
+    
+    added = reply_index.add(client, accepted.messages, accepted.reply.strip())
+    return {"status": "added" if added else "duplicate", "entries": reply_index.stats()["entries"]}
 
-# Загружаем промпт при старте приложения
-@app.on_event("startup")
-async def startup_event():
-    global SYSTEM_PROMPT
-    SYSTEM_PROMPT = load_system_prompt()
-    print("✅ Системный промпт загружен")
-    print(f"📝 Длина промпта: {len(SYSTEM_PROMPT)} символов")
-    print(f"🤖 Модель: {MODEL_NAME}")
-    if USE_CUSTOM_ENDPOINT:
-        print(f"🔗 Custom API endpoint: {CUSTOM_API_URL}")
-    else:
-        print(f"🔗 Standard Google API endpoint")
 
+# Поддерживаемые строковые форматы времени (ISO проверяется отдельно через fromisoformat)
+ISO_FORMAT = "iso"
+TIMESTAMP_FORMATS = [
+    ISO_FORMAT,
+    "%d.%m.%Y, %H:%M:%S",      # toLocaleString() в ru-RU
+    "%m/%d/%Y, %I:%M:%S %p",   # toLocaleString() в en-US
+    "%d.%m.%Y %H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%d.%m.%Y %H:%M",
+    "%H:%M",
+]
 
-class Message(BaseModel):
-    """Модель одного сообщения в диалоге"""
-    author: str  # Кто написал
-    timestamp: str  # Когда написал (ISO формат или строка)
-    content: str  # Что написал
+# Последний подошедший формат: следующий запрос начнёт с него
+_timestamp_format_hint = None
 
+# Счётчики разбора времени (для GET /)
+timestamp_stats = {"parsed": 0, "unparsed": 0}
 
-class DialogRequest(BaseModel):
-    """Модель запроса с диалогом"""
-    messages: List[Message]
-    context: str = ""  # Дополнительный контекст (опционально)
 
+class TimestampParser:
+    """
+    Разбирает время сообщений одного запроса. Подошедший формат запоминается
+    и проверяется первым, поэтому обычно на сообщение уходит одна попытка.
+    Нераспознанное время возвращается как None, а не подменяется текущим.
+    """
 
-class DialogResponse(BaseModel):
-    """Модель ответа с предложенным текстом"""
-    suggested_reply: str
-    processing_time: float
+    def __init__(self, current_time: Optional[datetime] = None):
+        self.current_time = current_time or datetime.now()
+        self.format = _timestamp_format_hint
+        self.failures = 0
 
+    def _parse_with(self, text: str, fmt: str) -> datetime:
+        if fmt == ISO_FORMAT:
+            parsed = datetime.fromisoformat(text.replace('Z', '+00:00'))
+        else:
+            parsed = datetime.strptime(text, fmt)
+            if fmt == "%H:%M":
+                # Только время: считаем, что это сегодня (или вчера, если получилось будущее)
+                parsed = datetime.combine(self.current_time.date(), parsed.time())
+                if parsed > self.current_time:
+                    parsed -= timedelta(days=1)
 
-@app.get("/")
-async def root():
-    """Проверка работоспособности API"""
-    return {
-        "status": "ok",
-        "service": "Respondo Backend",
-        "version": "2.1.0",
-        "prompt_loaded": SYSTEM_PROMPT is not None,
-        "model": MODEL_NAME,
-        "endpoint_type": "custom" if USE_CUSTOM_ENDPOINT else "standard",
-        "api_endpoint": CUSTOM_API_URL if USE_CUSTOM_ENDPOINT else "api.google.com"
-    }
+        # Время с часовым поясом приводим к локальному, как current_time
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone().replace(tzinfo=None)
+        return parsed
 
+    def parse(self, value: Union[int, float, str]) -> Optional[datetime]:
+        global _timestamp_format_hint
 
-@app.get("/health")
-async def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy"}
+        # Epoch-секунды (data-ts из VK) - числом или строкой из цифр
+        if isinstance(value, (int, float)) or value.strip().isdigit():
+            seconds = float(value)
+            if seconds > 1e11:
+                seconds /= 1000  # миллисекунды (Date.now() в JS)
+            try:
+                parsed = datetime.fromtimestamp(seconds)
+            except (OSError, OverflowError, ValueError):
+                # Вне диапазона платформы (или inf/nan) - считаем нераспознанным, а не падаем
+                self.failures += 1
+                timestamp_stats["unparsed"] += 1
+                return None
+            timestamp_stats["parsed"] += 1
+            return parsed
 
+        text = value.strip()
+        if self.format is not None:
+            try:
+                parsed = self._parse_with(text, self.format)
+                timestamp_stats["parsed"] += 1
+                return parsed
+            except (ValueError, OverflowError):
+                pass
 
-@app.post("/reload-prompt")
-async def reload_prompt():
-    """
-    Перезагружает системный промпт из файла без перезапуска сервера
-    """
-    global SYSTEM_PROMPT
-    SYSTEM_PROMPT = load_system_prompt()
-    return {
-        "status": "success",
-        "message": "Промпт перезагружен",
-        "prompt_length": len(SYSTEM_PROMPT)
-    }
+        for fmt in TIMESTAMP_FORMATS:
+            if fmt == self.format:
+                continue
+            try:
+                parsed = self._parse_with(text, fmt)
+            except (ValueError, OverflowError):
+                continue
+            self.format = _timestamp_format_hint = fmt
+            timestamp_stats["parsed"] += 1
+            return parsed
 
+        self.failures += 1
+        timestamp_stats["unparsed"] += 1
+        return None
 
-@app.post("/api/suggest-reply", response_model=DialogResponse)
-async def suggest_reply(request: DialogRequest):
-    """
-    Основной endpoint для получения предложенного ответа на диалог
-    
-    Принимает диалог, отправляет в LLM и возвращает предложенный ответ
-    """
-    start_time = datetime.now()
-    
-    try:
-        # Формируем промпт для LLM из истории диалога с временными метками
-        dialog_text = format_dialog_with_time_analysis(request.messages, start_time)
-        
-        # Отправляем запрос к LLM API
-        llm_response = await call_llm_api(dialog_text, request.context, start_time)
-        
-        processing_time = (datetime.now() - start_time).total_seconds()
-        
-        return DialogResponse(
-            suggested_reply=llm_response,
-            processing_time=processing_time
-        )
-    
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Ошибка при обработке запроса: {str(e)}"
-        )
+    def parse_all(self, messages: List[Message]) -> List[Optional[datetime]]:
+        return [self.parse(msg.timestamp) for msg in messages]
 
 
-def parse_timestamp(timestamp_str: str) -> datetime:
+def parse_timestamp(value: Union[int, float, str], current_time: Optional[datetime] = None) -> Optional[datetime]:
     """
-    Парсит timestamp из разных форматов
+    Парсит timestamp из разных форматов (epoch-секунды, ISO, toLocaleString и др.).
+    Возвращает None, если формат не распознан.
     """
-    # Попытка распарсить ISO формат
-    try:
-        return datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-    except:
-        pass
-    
-    # Попытка распарсить другие форматы
-    formats = [
-        "%Y-%m-%d %H:%M:%S",
-        "%d.%m.%Y %H:%M",
-        "%H:%M",
-    ]
-    
-    for fmt in formats:
-        try:
-            return datetime.strptime(timestamp_str, fmt)
-        except:
-            continue
-    
-    # Если не получилось распарсить, возвращаем текущее время
-    return datetime.now()
+    return TimestampParser(current_time).parse(value)
+
+
+def display_timestamp(value: Union[int, float, str]) -> str:
+    """Время сообщения для промпта: epoch-секунды переводим в читаемый вид"""
+    if isinstance(value, (int, float)) or value.strip().isdigit():
+        parsed = parse_timestamp(value)
+        # Нераспознанное время оставляем как пришло
+        return parsed.strftime('%Y-%m-%d %H:%M:%S') if parsed else str(value)
+    return value
 
 
 def analyze_time_gaps(messages: List[Message], current_time: datetime) -> str:
@@ -234,16 +2814,20 @@ def analyze_time_gaps(messages: List[Message], current_time: datetime) -> str:
         return "Диалог пуст."
     
     try:
-        timestamps = [parse_timestamp(msg.timestamp) for msg in messages]
+        parser = TimestampParser(current_time)
+        timestamps = parser.parse_all(messages)
+        known_timestamps = [ts for ts in timestamps if ts is not None]
+        
+        analysis = []
         
         # Анализируем время с последнего сообщения ДО СЕЙЧАС
         last_message_time = timestamps[-1]
-        time_since_last = current_time - last_message_time
-        
-        analysis = []
+        time_since_last = current_time - last_message_time if last_message_time else None
         
         # Анализ времени с последнего сообщения
-        if time_since_last.total_seconds() < 60:
+        if time_since_last is None:
+            analysis.append("❓ Время последнего сообщения не распознано")
+        elif time_since_last.total_seconds() < 60:
             analysis.append("📨 Последнее сообщение только что (менее минуты назад)")
         elif time_since_last.total_seconds() < 300:  # 5 минут
             minutes = int(time_since_last.total_seconds() / 60)
@@ -258,8 +2842,8 @@ def analyze_time_gaps(messages: List[Message], current_time: datetime) -> str:
             days = int(time_since_last.total_seconds() / 86400)
             analysis.append(f"📅 Последнее сообщение {days} дн назад")
         
-        # Анализ темпа диалога (если больше 1 сообщения)
-        if len(messages) > 1:
+        # Анализ темпа диалога (если известно время двух последних сообщений)
+        if len(messages) > 1 and timestamps[-1] and timestamps[-2]:
             last_gap = timestamps[-1] - timestamps[-2]
             
             if last_gap.total_seconds() < 60:
@@ -272,8 +2856,8 @@ def analyze_time_gaps(messages: List[Message], current_time: datetime) -> str:
                 analysis.append(f"💬 Пауза в диалоге была {hours} ч")
         
         # Общая длительность диалога
-        if len(messages) > 1:
-            total_duration = timestamps[-1] - timestamps[0]
+        if len(known_timestamps) > 1:
+            total_duration = known_timestamps[-1] - known_timestamps[0]
             if total_duration.total_seconds() < 3600:
                 analysis.append("📊 Быстрая беседа")
             elif total_duration.total_seconds() < 86400:
@@ -282,15 +2866,27 @@ def analyze_time_gaps(messages: List[Message], current_time: datetime) -> str:
                 days = int(total_duration.total_seconds() / 86400)
                 analysis.append(f"📊 Диалог длится {days} дн")
         
+        if parser.failures:
+            analysis.append(f"⚠️ Не распознано время {parser.failures} из {len(messages)} сообщений")
+        
         return " | ".join(analysis)
     
     except Exception as e:
         return f"Ошибка анализа времени: {str(e)}"
 
 
-def format_dialog_with_time_analysis(messages: List[Message], current_time: datetime) -> str:
+def format_message_line(msg: Message) -> str:
+    """Одна строка истории: [время] автор: текст"""
+    return f"[{display_timestamp(msg.timestamp)}] {msg.author}: {msg.content}"
+
+
+def format_dialog_with_time_analysis(messages: List[Message], current_time: datetime,
+                                     history_summary: Optional[str] = None,
+                                     summarized_count: int = 0) -> str:
     """
-    Форматирует список сообщений в текстовый диалог с анализом времени
+    Форматирует список сообщений в текстовый диалог с анализом времени.
+    Если передано краткое содержание, первые summarized_count сообщений
+    заменяются им, остальные выводятся как есть.
     """
     dialog_lines = []
     
@@ -304,19 +2900,206 @@ def format_dialog_with_time_analysis(messages: List[Message], current_time: date
     dialog_lines.append(time_analysis)
     dialog_lines.append(f"Всего сообщений: {len(messages)}")
     dialog_lines.append("")
+    
+    if summarized_count:
+        dialog_lines.append(f"=== КРАТКОЕ СОДЕРЖАНИЕ РАННЕЙ ПЕРЕПИСКИ ({summarized_count} сообщений) ===")
+        dialog_lines.append(history_summary or "(ранние сообщения опущены)")
+        dialog_lines.append("")
+    
     dialog_lines.append("=== ИСТОРИЯ ДИАЛОГА ===")
     
     # Форматируем сообщения
-    for i, msg in enumerate(messages):
-        prefix = "└─" if i == len(messages) - 1 else "├─"
-        dialog_lines.append(f"{prefix} [{msg.timestamp}] {msg.author}: {msg.content}")
+    recent_messages = messages[summarized_count:]
+    for i, msg in enumerate(recent_messages):
+        prefix = "└─" if i == len(recent_messages) - 1 else "├─"
+        dialog_lines.append(f"{prefix} {format_message_line(msg)}")
     
     return "\n".join(dialog_lines)
 
 
-async def call_llm_api(dialog: str, context: str = "", current_time: datetime = None) -> str:
+# Счётчики работы окна контекста
+context_window_stats = {
+    "requests_windowed": 0,
+    "messages_summarized": 0,
+    "tokens_saved_total": 0,
+    "summary_failures": 0,
+}
+
+SUMMARY_PROMPT = """Кратко перескажи переписку ниже в 3-6 предложениях.
+Сохрани важные факты: имена, суммы, даты, договорённости и вопросы, оставшиеся без ответа.
+Пиши на языке переписки, без вступлений и комментариев."""
+
+
+def estimate_tokens(text: str) -> int:
     """
-    Отправляет запрос к Gemini API и возвращает предложенный ответ
+    Грубая оценка числа токенов без обращения к API
+    (для кириллицы в среднем около 3 символов на токен)
+    """
+    return len(text) // 3 + 1
+
+
+def history_window_start(messages: List[Message]) -> int:
+    """
+    Возвращает, сколько первых сообщений нужно заменить кратким содержанием,
+    чтобы история уложилась в PROMPT_HISTORY_TOKEN_BUDGET (0 - все влезают)
+    """
+    if not PROMPT_HISTORY_TOKEN_BUDGET or len(messages) < 2:
+        return 0
+    
+    used = 0
+    tail_start = 0
+    for i in range(len(messages) - 1, -1, -1):
+        used += estimate_tokens(format_message_line(messages[i]))
+        if used > PROMPT_HISTORY_TOKEN_BUDGET:
+            tail_start = i + 1
+            break
+    
+    if tail_start == 0:
+        return 0
+    
+    # Округляем вверх до границы блока; последнее сообщение всегда остаётся как есть
+    cut = -(-tail_start // SUMMARY_BLOCK_SIZE) * SUMMARY_BLOCK_SIZE
+    return min(cut, len(messages) - 1)
+
+
+def prefix_hash(messages: List[Message]) -> str:
+    """Хэш префикса диалога - ключ для кэша кратких содержаний"""
+    normalized = [[msg.author, msg.timestamp, msg.content] for msg in messages]
+    raw = json.dumps([SYSTEM_PROMPT_VERSION, normalized], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def call_summary_llm(messages: List[Message], previous_summary: Optional[str] = None) -> str:
+    """
+    Просит LLM кратко пересказать сообщения. Если есть краткое содержание
+    более ранней части, оно дополняется, а не пересчитывается заново.
+    """
+    parts = [SUMMARY_PROMPT, ""]
+    if previous_summary:
+        parts.append(f"Краткое содержание предыдущей части переписки:\n{previous_summary}")
+        parts.append("")
+        parts.append("Продолжение переписки:")
+    parts.extend(format_message_line(msg) for msg in messages)
+    
+    prompt = "\n".join(parts)
+    PROMPT_CHARS.observe(len(prompt))
+    
+    return await llm_router.primary.generate(prompt, stage="summary_upstream")
+
+
+async def summarize_history(messages: List[Message], cut: int) -> str:
+    """
+    Краткое содержание первых cut сообщений. Считается один раз на префикс:
+    если есть содержание предыдущего блока, дописываем к нему только новые сообщения.
+    """
+    key = prefix_hash(messages[:cut])
+    summary = summary_cache.get(key)
+    if summary is not None:
+        return summary
+    
+    previous_cut = ((cut - 1) // SUMMARY_BLOCK_SIZE) * SUMMARY_BLOCK_SIZE
+    previous_summary = summary_cache.get(prefix_hash(messages[:previous_cut])) if previous_cut else None
+    start = previous_cut if previous_summary is not None else 0
+    
+    async def compute() -> str:
+        result = await call_summary_llm(messages[start:cut], previous_summary)
+        summary_cache.set(key, result)
+        return result
+    
+    return await summary_flight.do(key, compute)
+
+
+async def build_dialog_prompt(messages: List[Message], current_time: datetime) -> Tuple[str, int]:
+    """
+    Форматирует диалог в пределах бюджета токенов.
+    Возвращает текст диалога и число сэкономленных токенов истории.
+    """
+    cut = history_window_start(messages)
+    if cut == 0:
+        return format_dialog_with_time_analysis(messages, current_time), 0
+    
+    try:
+        summary = await summarize_history(messages, cut)
+    except HTTPException:
+        raise
+    except Exception as e:
+        # Без краткого содержания ранние сообщения просто опускаются
+        print(f"⚠️  Не удалось получить краткое содержание истории: {e}")
+        context_window_stats["summary_failures"] += 1
+        summary = None
+    
+    original_tokens = sum(estimate_tokens(format_message_line(msg)) for msg in messages[:cut])
+    tokens_saved = max(original_tokens - (estimate_tokens(summary) if summary else 0), 0)
+    
+    context_window_stats["requests_windowed"] += 1
+    context_window_stats["messages_summarized"] += cut
+    context_window_stats["tokens_saved_total"] += tokens_saved
+    
+    dialog_text = format_dialog_with_time_analysis(messages, current_time, summary, cut)
+    return dialog_text, tokens_saved
+
+
+# Границы (в секундах) для грубого округления "сколько прошло с последнего сообщения".
+# Ключ кэша использует корзину вместо точного времени, иначе каждый запрос уникален.
+CACHE_TIME_BUCKETS = [
+    (60, "now"),
+    (300, "5m"),
+    (900, "15m"),
+    (3600, "1h"),
+    (6 * 3600, "6h"),
+    (86400, "1d"),
+]
+
+
+def time_since_last_bucket(messages: List[Message], current_time: datetime) -> str:
+    """
+    Возвращает корзину времени с последнего сообщения (для ключа кэша)
+    """
+    if not messages:
+        return "empty"
+    
+    last_message_time = parse_timestamp(messages[-1].timestamp, current_time)
+    if last_message_time is None:
+        return "unknown"
+    
+    seconds = (current_time - last_message_time).total_seconds()
+    for limit, label in CACHE_TIME_BUCKETS:
+        if seconds < limit:
+            return label
+    return f"{int(seconds // 86400)}d"
+
+
+def requested_candidates(request: DialogRequest) -> int:
+    """Сколько вариантов ответа просит клиент (в пределах 1..CANDIDATES_MAX)"""
+    return min(max(request.candidate_count, 1), CANDIDATES_MAX)
+
+
+def build_cache_key(request: DialogRequest, current_time: datetime) -> str:
+    """
+    Ключ кэша: нормализованные сообщения, контекст, модель, версия промпта
+    и округлённое время с последнего сообщения
+    """
+    normalized_messages = [
+        [msg.author.strip(), str(msg.timestamp).strip(), " ".join(msg.content.split())]
+        for msg in request.messages
+    ]
+    key_data = [
+        MODEL_NAME,
+        SYSTEM_PROMPT_VERSION,
+        " ".join(request.context.split()),
+        time_since_last_bucket(request.messages, current_time),
+        normalized_messages,
+    ]
+    candidate_count = requested_candidates(request)
+    if candidate_count > 1:
+        key_data.append(candidate_count)
+    raw_key = json.dumps(key_data, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+def build_full_prompt(dialog: str, context: str = "", current_time: datetime = None) -> str:
+    """
+    Собирает финальный промпт: системный промпт, текущее время, контекст и диалог
     """
     
     # Используем загруженный системный промпт
@@ -339,20 +3122,588 @@ async def call_llm_api(dialog: str, context: str = "", current_time: datetime =
 
 Проанализируй диалог выше (обрати особое внимание на временной анализ и текущее время) и предложи подходящий ответ на последнее сообщение."""
     
-    try:
-        # Используем Google Genai SDK
-        response = genai_client.models.generate_content(
-            model=MODEL_NAME,
-            contents=full_prompt
+    return full_prompt
+
+
+class CircuitBreaker:
+    """
+    Размыкается после failure_threshold ошибок подряд: вызовы сразу отклоняются.
+    Через reset_timeout секунд пропускает один пробный вызов (half-open):
+    успех замыкает цепь, ошибка снова размыкает.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.opens = 0
+        self.rejected = 0
+
+    def allow_request(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opens += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """Вызов завершился без вердикта (отменён или ошибка клиента) - пробу можно повторить"""
+        self._probe_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.reset_timeout - (time.monotonic() - self.opened_at)))
+
+    def stats(self) -> dict:
+        return {
+            "state": self.OPEN if self.is_open else (self.HALF_OPEN if self.state == self.OPEN else self.state),
+            "consecutive_failures": self.consecutive_failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "retry_after": self.retry_after() if self.is_open else 0,
+        }
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Временные ошибки, после которых есть смысл повторить вызов"""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    from google.genai import errors as genai_errors
+    if isinstance(error, genai_errors.APIError):
+        return error.code == 429 or error.code >= 500
+    return False
+
+
+def response_candidates(response) -> List[str]:
+    """
+    Тексты вариантов из ответа модели: сначала завершённые штатно,
+    затем по средней log-вероятности токенов (если модель её вернула)
+    """
+    candidates = getattr(response, "candidates", None)
+    if not candidates or len(candidates) == 1:
+        text = (response.text or "").strip()
+        return [text] if text else []
+    
+    from google.genai import types
+    ranked = []
+    for index, candidate in enumerate(candidates):
+        parts = candidate.content.parts if candidate.content and candidate.content.parts else []
+        text = "".join(part.text or "" for part in parts).strip()
+        if not text:
+            continue
+        finished = candidate.finish_reason in (None, types.FinishReason.STOP)
+        avg_logprobs = candidate.avg_logprobs if candidate.avg_logprobs is not None else 0.0
+        ranked.append((not finished, -avg_logprobs, index, text))
+    return [text for *_, text in sorted(ranked)]
+
+
+def normalize_candidate(text: str) -> str:
+    return " ".join("".join(ch for ch in text.lower() if ch.isalnum() or ch.isspace()).split())
+
+
+def rank_candidates(replies: List[str], limit: int) -> List[str]:
+    """
+    Убирает повторы и почти одинаковые формулировки, сохраняя порядок ранжирования
+    """
+    unique = []
+    normalized = []
+    for reply in replies:
+        key = normalize_candidate(reply)
+        if any(key == seen or difflib.SequenceMatcher(None, key, seen).ratio() >= CANDIDATE_SIMILARITY
+               for seen in normalized):
+            continue
+        unique.append(reply)
+        normalized.append(key)
+        if len(unique) >= limit:
+            break
+    return unique
+
+
+class LLMRoute:
+    """
+    Модель и endpoint, в которые можно отправить запрос. Следит за временем ответа
+    (адаптивный таймаут), повторяет временные ошибки и держит свой circuit breaker.
+    """
+
+    def __init__(self, name: str, model: str, use_custom_endpoint: bool = USE_CUSTOM_ENDPOINT):
+        self.name = name
+        self.model = model
+        self.use_custom_endpoint = use_custom_endpoint
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self._latencies = deque(maxlen=200)  # Время успешных ответов
+        self.supports_candidate_count = LLM_CANDIDATE_COUNT_SUPPORTED
+        CIRCUIT_OPEN.labels(route=self.label).set_function(lambda: float(self.breaker.is_open))
+
+    @property
+    def label(self) -> str:
+        # Имя маршрута в метке обязательно: основной и запасной могут вести в одну модель и endpoint
+        endpoint = "custom" if self.use_custom_endpoint else "standard"
+        return f"{self.name}:{endpoint}:{self.model}"
+
+    @property
+    def client(self):
+        return get_genai_client(self.use_custom_endpoint)
+
+    def _latency_quantile(self, quantile: float) -> Optional[float]:
+        if len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(int(quantile * len(ordered)), len(ordered) - 1)]
+
+    def typical_latency(self) -> float:
+        """Медианное время успешного ответа (0, пока ответов не было)"""
+        if not self._latencies:
+            return 0.0
+        ordered = sorted(self._latencies)
+        return ordered[len(ordered) // 2]
+
+    def adaptive_timeout(self) -> float:
+        p99 = self._latency_quantile(0.99)
+        if p99 is None:
+            return LLM_TIMEOUT_INITIAL
+        return min(max(p99 * LLM_TIMEOUT_MULTIPLIER, LLM_TIMEOUT_MIN), LLM_TIMEOUT_MAX)
+
+    def unavailable(self) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail=f"LLM ({self.label}) временно недоступна, повторите позже",
+            headers={"Retry-After": str(self.breaker.retry_after())}
+        )
+
+    async def _call_once(self, prompt: str, timeout: float, stage: str, candidate_count: int = 1) -> List[str]:
+        kwargs = {}
+        if candidate_count > 1:
+            from google.genai import types
+            kwargs["config"] = types.GenerateContentConfig(candidate_count=candidate_count)
+        
+        # Ждём свободный слот (или сразу получаем 503, если очередь заполнена)
+        async with llm_limiter.slot():
+            start = time.perf_counter()
+            budget = max(remaining_deadline(), 0)
+            # Асинхронный клиент SDK не блокирует event loop во время ожидания ответа
+            try:
+                with timed_stage(stage):
+                    response = await asyncio.wait_for(
+                        self.client.aio.models.generate_content(model=self.model, contents=prompt, **kwargs),
+                        timeout=min(timeout, budget)
+                    )
+            except asyncio.TimeoutError:
+                # Вызов ограничил срок самого запроса (X-Request-Timeout) - LLM тут ни при чём,
+                # и на circuit breaker это влиять не должно
+                if budget < timeout:
+                    raise deadline_exceeded()
+                raise
+            self._latencies.append(time.perf_counter() - start)
+
+        replies = response_candidates(response)
+        if not replies:
+            UPSTREAM_ERRORS.labels(error="EmptyResponse").inc()
+            raise ValueError(f"{self.label}: модель вернула пустой ответ")
+        return replies
+
+    async def generate(self, prompt: str, stage: str = "upstream") -> str:
+        return (await self.generate_candidates(prompt, 1, stage))[0]
+
+    async def generate_many(self, prompt: str, candidate_count: int, stage: str = "upstream") -> List[str]:
+        """
+        Несколько вариантов ответа: одним вызовом с candidate_count, если модель
+        это умеет, иначе параллельными вызовами
+        """
+        if candidate_count > 1 and self.supports_candidate_count:
+            from google.genai import errors as genai_errors
+            try:
+                return await self.generate_candidates(prompt, candidate_count, stage)
+            except genai_errors.ClientError as e:
+                if e.code != 400:
+                    raise
+                self.supports_candidate_count = False
+                print(f"⚠️  {self.label}: candidate_count не поддерживается, варианты запрашиваются параллельно")
+        
+        results = await asyncio.gather(
+            *[self.generate_candidates(prompt, 1, stage) for _ in range(candidate_count)],
+            return_exceptions=True
         )
+        replies = [result[0] for result in results if not isinstance(result, BaseException)]
+        if not replies:
+            raise results[0]
+        return replies
+
+    async def generate_candidates(self, prompt: str, candidate_count: int, stage: str = "upstream") -> List[str]:
+        if not self.breaker.allow_request():
+            raise self.unavailable()
+
+        attempt = 0
+        while True:
+            if remaining_deadline() <= 0:
+                self.breaker.release_probe()
+                raise deadline_exceeded()
+
+            try:
+                replies = await self._call_once(prompt, self.adaptive_timeout(), stage, candidate_count)
+            except (asyncio.CancelledError, HTTPException):
+                self.breaker.release_probe()
+                raise
+            except Exception as e:
+                UPSTREAM_ERRORS.labels(error=type(e).__name__).inc()
+                if not is_retryable_error(e):
+                    # Ошибка запроса, а не недоступность LLM - на breaker не влияет
+                    self.breaker.release_probe()
+                    raise
+
+                self.breaker.record_failure()
+                # Повторяем, только если breaker ещё замкнут и до срока успеем дождаться ответа
+                backoff = random.uniform(0, LLM_RETRY_BASE_DELAY * 2 ** attempt)
+                expected_latency = self._latency_quantile(0.5) or 0.0
+                if attempt >= LLM_MAX_RETRIES or self.breaker.is_open \
+                        or remaining_deadline() < backoff + expected_latency:
+                    raise
+
+                attempt += 1
+                LLM_RETRIES.labels(route=self.label).inc()
+                await asyncio.sleep(backoff)
+                if not self.breaker.allow_request():
+                    raise self.unavailable()
+                continue
+
+            self.breaker.record_success()
+            return replies
+
+
+class HedgedRouter:
+    """
+    Отправляет запрос в основной маршрут; если ответа нет дольше адаптивной задержки
+    (квантиль недавних времён ответа), дублирует его во второй маршрут.
+    Побеждает первый успешный ответ, второй вызов отменяется.
+    """
+
+    def __init__(self, primary: LLMRoute, hedge: Optional[LLMRoute], quantile: float,
+                 initial_delay: float, min_delay: float, max_delay: float):
+        self.primary = primary
+        self.hedge = hedge
+        self.quantile = quantile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._latencies = deque(maxlen=200)  # Недавние времена ответа основного маршрута
+        self._first_token_latencies = deque(maxlen=200)  # То же до первого фрагмента потока
+        self.requests = 0
+        self.hedges_sent = 0
+        self.hedges_skipped = 0
+        self.primary_wins = 0
+        self.hedge_wins = 0
+
+    def _delay(self, latencies: deque) -> float:
+        if len(latencies) < 20:
+            return self.initial_delay
+        ordered = sorted(latencies)
+        value = ordered[min(int(self.quantile * len(ordered)), len(ordered) - 1)]
+        return min(max(value, self.min_delay), self.max_delay)
+
+    def hedge_delay(self) -> float:
+        return self._delay(self._latencies)
+
+    def first_token_delay(self) -> float:
+        return self._delay(self._first_token_latencies)
+
+    async def _timed_primary(self, prompt: str, candidate_count: int) -> List[str]:
+        start = time.perf_counter()
+        try:
+            return await self.primary.generate_many(prompt, candidate_count)
+        finally:
+            # Отменённый вызов тоже учитываем: он шёл как минимум столько
+            self._latencies.append(time.perf_counter() - start)
+
+    async def generate(self, prompt: str) -> str:
+        return (await self.generate_many(prompt, 1))[0]
+
+    async def generate_many(self, prompt: str, candidate_count: int) -> List[str]:
+        self.requests += 1
+        if self.hedge is None:
+            return await self._timed_primary(prompt, candidate_count)
+
+        primary_task = asyncio.ensure_future(self._timed_primary(prompt, candidate_count))
+        tasks = {primary_task: "primary"}
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=self.hedge_delay())
+            if done and primary_task.exception() is None:
+                self.primary_wins += 1
+                HEDGE_EVENTS.labels(event="primary_win").inc()
+                return primary_task.result()
+
+            # Основной маршрут медлит или уже упал - пробуем второй.
+            # Хедж не должен вставать в очередь и вытеснять обычные запросы
+            if not llm_limiter.has_free_slot():
+                self.hedges_skipped += 1
+                HEDGE_EVENTS.labels(event="skipped").inc()
+                return await primary_task
+
+            self.hedges_sent += 1
+            HEDGE_EVENTS.labels(event="sent").inc()
+            tasks[asyncio.ensure_future(self.hedge.generate_many(prompt, candidate_count))] = "hedge"
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if tasks[task] == "hedge":
+                            self.hedge_wins += 1
+                            HEDGE_EVENTS.labels(event="hedge_win").inc()
+                        else:
+                            self.primary_wins += 1
+                            HEDGE_EVENTS.labels(event="primary_win").inc()
+                        return task.result()
+
+            # Оба вызова завершились ошибкой - отдаём ошибку основного
+            return primary_task.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def stream(self, dialog: str, context: str, current_time: datetime) -> AsyncIterator[str]:
+        """
+        Потоковый ответ с хеджированием времени до первого фрагмента: если основной маршрут
+        не прислал его за first_token_delay(), тот же запрос потоком уходит во второй маршрут
+        (только при свободном слоте LLM), и дальше читается поток, ответивший первым.
         
-        return response.text.strip()
+        Слот основного потока занимает вызывающий код, слот хеджа - сам роутер.
+        Итог вызова записывается в circuit breaker маршрута, чей поток был прочитан.
+        """
+        self.requests += 1
+        started = time.perf_counter()
+        primary_stream = stream_llm_api(dialog, context, current_time, self.primary)
+        primary_first = asyncio.ensure_future(primary_stream.__anext__())
+        streams = {primary_first: (self.primary, primary_stream)}
+        hedge_slot = AsyncExitStack()
+        winner = primary_first
         
+        def failed(task: asyncio.Task) -> bool:
+            # StopAsyncIteration - пустой, но успешный поток
+            return task.exception() is not None and not isinstance(task.exception(), StopAsyncIteration)
+        
+        try:
+            if self.hedge is not None:
+                done, _ = await asyncio.wait({primary_first}, timeout=self.first_token_delay())
+                if not done or failed(primary_first):
+                    # Хедж не должен вставать в очередь и вытеснять обычные запросы
+                    if llm_limiter.has_free_slot() and self.hedge.breaker.allow_request():
+                        self.hedges_sent += 1
+                        HEDGE_EVENTS.labels(event="sent").inc()
+                        hedge_stream = stream_llm_api(dialog, context, current_time, self.hedge)
+                        
+                        async def hedge_first():
+                            await hedge_slot.enter_async_context(llm_limiter.slot())
+                            return await hedge_stream.__anext__()
+                        
+                        streams[asyncio.ensure_future(hedge_first())] = (self.hedge, hedge_stream)
+                    else:
+                        self.hedges_skipped += 1
+                        HEDGE_EVENTS.labels(event="skipped").inc()
+                
+                pending = set(streams)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    succeeded = [task for task in done if not failed(task)]
+                    if succeeded:
+                        winner = succeeded[0]
+                        break
+                
+                # Ошибка маршрута, проигравшего гонку, всё равно идёт в его breaker
+                for task, (route, _) in streams.items():
+                    if task is not winner and task.done() and failed(task):
+                        error = task.exception()
+                        if isinstance(error, asyncio.TimeoutError) or is_retryable_error(error):
+                            route.breaker.record_failure()
+                
+                # Если основной маршрут не успел, его время до первого токена не меньше прошедшего
+                if not primary_first.done() or not failed(primary_first):
+                    self._first_token_latencies.append(time.perf_counter() - started)
+                if winner.done() and not failed(winner):
+                    label = "hedge_win" if streams[winner][0] is self.hedge else "primary_win"
+                    if label == "hedge_win":
+                        self.hedge_wins += 1
+                    else:
+                        self.primary_wins += 1
+                    HEDGE_EVENTS.labels(event=label).inc()
+            
+            route, winner_stream = streams[winner]
+            try:
+                try:
+                    chunk = await winner
+                except StopAsyncIteration:
+                    route.breaker.record_success()
+                    return
+                yield chunk
+                async for chunk in winner_stream:
+                    yield chunk
+            except (asyncio.TimeoutError, Exception) as e:
+                if isinstance(e, asyncio.TimeoutError) or is_retryable_error(e):
+                    route.breaker.record_failure()
+                else:
+                    route.breaker.release_probe()
+                raise
+            route.breaker.record_success()
+        finally:
+            for task, (route, route_stream) in streams.items():
+                if not task.done():
+                    task.cancel()
+                    await asyncio.wait({task})
+                if task is not winner and route is self.hedge:
+                    route.breaker.release_probe()
+                await route_stream.aclose()
+            await hedge_slot.aclose()
+
+    @property
+    def routes(self) -> List[LLMRoute]:
+        return [self.primary] + ([self.hedge] if self.hedge else [])
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.hedge is not None,
+            "primary": self.primary.label,
+            "hedge": self.hedge.label if self.hedge else None,
+            "hedge_delay": round(self.hedge_delay(), 3),
+            "requests": self.requests,
+            "hedges_sent": self.hedges_sent,
+            "hedges_skipped": self.hedges_skipped,
+            "hedge_rate": round(self.hedges_sent / self.requests, 4) if self.requests else 0.0,
+            "primary_wins": self.primary_wins,
+            "hedge_wins": self.hedge_wins,
+            "hedge_win_rate": round(self.hedge_wins / self.hedges_sent, 4) if self.hedges_sent else 0.0,
+        }
+
+
+llm_router = HedgedRouter(
+    primary=LLMRoute("primary", MODEL_NAME, USE_CUSTOM_ENDPOINT),
+    hedge=LLMRoute("hedge", HEDGE_MODEL_NAME, HEDGE_USE_CUSTOM_ENDPOINT) if LLM_HEDGE_ENABLED else None,
+    quantile=HEDGE_DELAY_QUANTILE,
+    initial_delay=HEDGE_INITIAL_DELAY,
+    min_delay=HEDGE_MIN_DELAY,
+    max_delay=HEDGE_MAX_DELAY,
+)
+
+
+async def call_llm_api(dialog: str, context: str = "", current_time: datetime = None) -> str:
+    """
+    Отправляет запрос к Gemini API и возвращает предложенный ответ
+    """
+    return (await call_llm_candidates(dialog, context, current_time, 1))[0]
+
+
+async def call_llm_candidates(dialog: str, context: str = "", current_time: datetime = None,
+                              candidate_count: int = 1) -> List[str]:
+    """
+    Запрашивает у Gemini candidate_count вариантов ответа и возвращает
+    их без повторов, от лучшего к худшему
+    """
+    full_prompt = build_full_prompt(dialog, context, current_time)
+    PROMPT_CHARS.observe(len(full_prompt))
+    record_prompt_size(len(full_prompt))
+    
+    try:
+        replies = await llm_router.generate_many(full_prompt, candidate_count)
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504,
+            detail="Gemini API не ответил за отведённое время"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Ошибка при вызове Gemini API: {str(e)}"
         )
+    
+    replies = rank_candidates(replies, candidate_count)
+    for reply in replies:
+        RESPONSE_CHARS.observe(len(reply))
+    return replies
+
+
+async def stream_llm_api(dialog: str, context: str = "", current_time: datetime = None,
+                         route: Optional["LLMRoute"] = None) -> AsyncIterator[str]:
+    """
+    Потоково генерирует ответ Gemini, отдавая текст по мере поступления.
+    Слот в llm_limiter должен занимать вызывающий код.
+    
+    Ожидание первого фрагмента и каждого следующего ограничено адаптивным таймаутом
+    маршрута и сроком запроса: зависший поток не держит слот бесконечно
+    """
+    route = route or llm_router.primary
+    full_prompt = build_full_prompt(dialog, context, current_time)
+    PROMPT_CHARS.observe(len(full_prompt))
+    record_prompt_size(len(full_prompt))
+    
+    async def bounded(awaitable):
+        timeout = route.adaptive_timeout()
+        budget = max(remaining_deadline(), 0)
+        try:
+            return await asyncio.wait_for(awaitable, timeout=min(timeout, budget))
+        except asyncio.TimeoutError:
+            # Истёк срок самого запроса - это не сбой LLM (см. LLMRoute._call_once)
+            if budget < timeout:
+                raise deadline_exceeded()
+            raise
+    
+    with timed_stage("upstream"):
+        response_chars = 0
+        stream = await bounded(route.client.aio.models.generate_content_stream(
+            model=route.model,
+            contents=full_prompt
+        ))
+        chunks = stream.__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await bounded(chunks.__anext__())
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    response_chars += len(chunk.text)
+                    yield chunk.text
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+        RESPONSE_CHARS.observe(response_chars)
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Форматирует одно server-sent событие"""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode('utf-8')}\n\n"
 
 
 @app.post("/api/test")
@@ -363,17 +3714,26 @@ async def test_endpoint(request: DialogRequest):
     current_time = datetime.now()
     dialog_text = format_dialog_with_time_analysis(request.messages, current_time)
     time_analysis = analyze_time_gaps(request.messages, current_time)
+    parsed_timestamps = TimestampParser(current_time).parse_all(request.messages)
     
     return {
         "current_time": current_time.isoformat(),
         "formatted_dialog": dialog_text,
         "time_analysis": time_analysis,
         "message_count": len(request.messages),
+        "unparsed_timestamps": [i for i, ts in enumerate(parsed_timestamps) if ts is None],
         "system_prompt_length": len(SYSTEM_PROMPT) if SYSTEM_PROMPT else 0,
         "test_reply": "Это тестовый ответ. LLM не вызывался."
     }
 
 
+record_startup_phase("import", time.perf_counter() - IMPORT_STARTED)
+
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    if WORKERS > 1:
+        # Несколько процессов: приложение импортируется каждым воркером заново
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+Воспроизведение журнала запросов (REQUEST_LOG_ENABLED) для бенчмарка на реальной
+форме трафика: запросы отправляются с теми же интервалами, что и в журнале
+(или быстрее/медленнее в --speed раз).
+
+По умолчанию приложение запускается в том же процессе с заглушкой LLM из benchmark.py,
+с --url запросы идут на работающий сервер.
+
+Примеры:
+    python replay.py request_logs
+    python replay.py request_logs --speed 10 --profile slow-tail --output replay.json
+    python replay.py request_logs/requests-20260101-120000-4242-0.jsonl.gz --url http://localhost:8000
+    python replay.py request_logs --speed 10 --compare replay.json
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import sys
+import time
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+from benchmark import PROFILES, compare, load_app, percentile
+
+
+def read_records(paths, limit: int = 0) -> list:
+    """Читает записи из файлов журнала (или всех *.jsonl.gz в каталогах), по времени"""
+    files = []
+    for path in map(Path, paths):
+        files.extend(sorted(path.glob("requests-*.jsonl.gz")) if path.is_dir() else [path])
+
+    records = []
+    for path in files:
+        # Файл состоит из нескольких gzip-блоков - gzip.open читает их подряд
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record["ts"])
+    return records[:limit] if limit else records
+
+
+def request_body(record: dict, bypass_cache: bool) -> dict:
+    """Тело запроса из записи журнала: полная история без серверной сессии"""
+    request = record["request"]
+    return {
+        "messages": request["messages"],
+        "context": request["context"],
+        "candidate_count": request.get("candidate_count", 1),
+        "bypass_cache": bypass_cache or request.get("bypass_cache", False),
+    }
+
+
+async def replay(client: httpx.AsyncClient, records: list, args) -> list:
+    """Отправляет записи по расписанию журнала; задержки считаются по путям"""
+    latencies = {}
+    errors = {}
+    lags = []
+    first_ts = records[0]["ts"]
+    started = time.perf_counter()
+
+    async def send(record: dict):
+        path = record["path"]
+        # Сохраняем разбиение трафика по клиентам для честной очереди
+        headers = {"x-install-id": f"replay-{record.get('client', 'anonymous')}"}
+        body = request_body(record, args.bypass_cache)
+
+        delay = (record["ts"] - first_ts) / args.speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        lags.append(max(-delay, 0.0))
+
+        start = time.perf_counter()
+        try:
+            async with client.stream("POST", path, json=body, headers=headers) as response:
+                failed = response.status_code != 200
+                async for line in response.aiter_lines():
+                    # Ошибка потока приходит событием, а не статусом
+                    failed = failed or line.startswith("event: error")
+        except httpx.HTTPError:
+            failed = True
+        latencies.setdefault(path, []).append(time.perf_counter() - start)
+        errors[path] = errors.get(path, 0) + failed
+
+    await asyncio.gather(*[send(record) for record in records])
+    elapsed = time.perf_counter() - started
+
+    lags.sort()
+    results = []
+    for path, values in sorted(latencies.items()):
+        values.sort()
+        results.append({
+            "endpoint": path,
+            "messages": "replay",
+            "requests": len(values),
+            "errors": errors[path],
+            "rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            # Насколько отправка отставала от расписания (перегружен сам генератор нагрузки)
+            "schedule_lag_p95_ms": round(percentile(lags, 0.95) * 1000, 2),
+        })
+    return results
+
+
+async def run_replay(args) -> dict:
+    records = read_records(args.logs, args.limit)
+    if not records:
+        print("❌ В журнале нет записей")
+        sys.exit(1)
+    span = records[-1]["ts"] - records[0]["ts"]
+    print(f"📼 Записей: {len(records)}, длительность {span:.1f} с, "
+          f"воспроизведение ~{span / args.speed:.1f} с (x{args.speed})")
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "logs": [str(path) for path in args.logs],
+        "speed": args.speed,
+        "records": len(records),
+    }
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=None) as client:
+            results = await replay(client, records, args)
+        report["target"] = args.url
+    else:
+        profile = PROFILES[args.profile]
+        main = load_app(profile, args.seed)
+        transport = httpx.ASGITransport(app=main.app)
+        async with main.lifespan(main.app), \
+                httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=None) as client:
+            await main.warmup_task
+            results = await replay(client, records, args)
+        report["profile"] = asdict(profile)
+        report["llm_calls"] = main.genai_client.aio.models.calls
+
+    for result in results:
+        print(f"{result['endpoint']:<28} {result['requests']:>6} запр. | {result['rps']:>8.1f} RPS | "
+              f"p50 {result['p50_ms']:>8.1f} мс | p95 {result['p95_ms']:>8.1f} мс | "
+              f"p99 {result['p99_ms']:>8.1f} мс | ошибок {result['errors']}")
+    report["results"] = results
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воспроизведение журнала запросов Respondo backend")
+    parser.add_argument("logs", nargs="+", help="файлы журнала или каталоги с ними")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="во сколько раз быстрее исходного трафика")
+    parser.add_argument("--limit", type=int, default=0, help="воспроизвести только первые N записей")
+    parser.add_argument("--url", help="адрес работающего сервера (по умолчанию - в процессе с заглушкой)")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="typical",
+                        help="профиль задержек заглушки LLM")
+    parser.add_argument("--bypass-cache", action="store_true", help="не брать ответы из кэша")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="сохранить результаты в JSON-файл")
+    parser.add_argument("--compare", help="сравнить с ранее сохранённым JSON-файлом")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="допустимое ухудшение при сравнении (доля)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print("=" * 50)
+    print("ВОСПРОИЗВЕДЕНИЕ ЖУРНАЛА ЗАПРОСОВ")
+    print("=" * 50)
+
+    report = asyncio.run(run_replay(args))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты сохранены в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.threshold):
+            print("\n❌ Обнаружены регрессии")
+            sys.exit(1)
+        print("\n✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
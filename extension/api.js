@@ -0,0 +1,53 @@
+// Общие для popup и content script настройки и помощники API Respondo.
+// Подключается и в manifest.json (content_scripts), и в popup.html перед основным скриптом,
+// чтобы prefetch и popup всегда отправляли один и тот же запрос
+
+const API_URL = 'http://localhost:8000';
+
+// Сколько вариантов ответа просить у сервера (переключаются без новых запросов)
+const CANDIDATE_COUNT = 3;
+
+// Авторы в компактном формате: в колонке author передаётся индекс в этом списке
+const AUTHORS = ['Клиент', 'Вы'];
+
+// Тела больше этого размера (в символах) отправляем сжатыми gzip
+const COMPRESS_MIN_LENGTH = 1024;
+
+// Идентификатор установки расширения: по нему сервер делит квоту и очередь между операторами
+async function getInstallId() {
+  const data = await chrome.storage.local.get('installId');
+  if (data.installId) return data.installId;
+  const installId = crypto.randomUUID();
+  await chrome.storage.local.set({ installId: installId });
+  return installId;
+}
+
+// Преобразование сообщений из content script в компактный колоночный формат API
+function toCompactMessages(messages) {
+  return {
+    authors: AUTHORS,
+    author: messages.map(msg => (msg.role === 'user' ? 0 : 1)),
+    // data-ts из VK (epoch-секунды) сервер разбирает сам; строка - только если его нет
+    timestamp: messages.map(msg => (msg.timestamp != null ? msg.timestamp : (msg.date || ''))),
+    content: messages.map(msg => msg.text),
+    id: messages.map(msg => msg.id)
+  };
+}
+
+// Сжатие строки в gzip средствами браузера
+async function gzip(text) {
+  const stream = new Blob([text]).stream().pipeThrough(new CompressionStream('gzip'));
+  return new Response(stream).arrayBuffer();
+}
+
+// Заголовки и тело JSON-запроса к API: крупные тела сжимаются gzip
+async function encodeRequest(requestData) {
+  const headers = { 'Content-Type': 'application/json', 'X-Install-Id': await getInstallId() };
+  let body = JSON.stringify(requestData);
+
+  if (body.length >= COMPRESS_MIN_LENGTH && typeof CompressionStream !== 'undefined') {
+    body = await gzip(body);
+    headers['Content-Encoding'] = 'gzip';
+  }
+  return { headers, body };
+}
@@ -1,78 +1,239 @@
 // content.js - скрипт для извлечения сообщений из VK
 
+// Подробный лог извлечения (для отладки разметки VK)
+const DEBUG = false;
+
+function debugLog(...args) {
+  if (DEBUG) console.log(...args);
+}
+
+// Селекторы сообщений по порядку; первый сработавший запоминается
+const MESSAGE_SELECTORS = ['.im-mess._im_mess', '[class*="im-mess"]', 'li[data-msgid]'];
+const TEXT_SELECTORS = ['.im-mess--text', '[class*="mess--text"]', '.message_text'];
+
+let messageSelector = null;
+
+// Извлечённые сообщения: ключ (data-msgid) -> { node, message }.
+// MutationObserver отмечает новые и изменённые узлы, и перечитываются только они,
+// поэтому стоимость извлечения не растёт с длиной истории
+const messageStore = new Map();
+const pendingNodes = new Set();
+const nodeKeys = new WeakMap();  // Ключи для узлов без data-msgid
+let nodeKeyCounter = 0;
+let orderedMessages = null;  // Сообщения в порядке DOM; null - нужно пересобрать
+let needsPrune = false;
+let needsFullScan = true;
+
+function resolveSelector() {
+  for (const selector of MESSAGE_SELECTORS) {
+    const elements = document.querySelectorAll(selector);
+    debugLog(`Найдено элементов с ${selector}:`, elements.length);
+    if (elements.length > 0) {
+      messageSelector = selector;
+      return elements;
+    }
+  }
+  return [];
+}
+
+function messageKey(node) {
+  const msgId = node.getAttribute('data-msgid');
+  if (msgId) return msgId;
+  if (!nodeKeys.has(node)) nodeKeys.set(node, `node:${++nodeKeyCounter}`);
+  return nodeKeys.get(node);
+}
+
+// Текст без innerText: textContent не вызывает пересчёт раскладки страницы.
+// Переносы строк в VK - это <br>, эмодзи - картинки с alt
+function readText(element) {
+  let text = '';
+  for (const node of element.childNodes) {
+    if (node.nodeType === Node.TEXT_NODE) {
+      text += node.nodeValue;
+    } else if (node.nodeName === 'BR') {
+      text += '\n';
+    } else if (node.nodeName === 'IMG') {
+      text += node.getAttribute('alt') || '';
+    } else if (node.nodeType === Node.ELEMENT_NODE) {
+      text += readText(node);
+    }
+  }
+  return text;
+}
+
+function readMessage(msg) {
+  const isOutgoing = msg.classList.contains('im-mess_out');
+  const timestamp = msg.getAttribute('data-ts');
+  
+  // Пробуем разные селекторы для текста
+  let textElement = null;
+  for (const selector of TEXT_SELECTORS) {
+    textElement = msg.querySelector(selector);
+    if (textElement) break;
+  }
+  
+  let text = textElement ? readText(textElement).trim() : '';
+  
+  // Если не нашли текст, берем весь текст из элемента
+  if (!text) {
+    text = readText(msg).trim();
+  }
+  
+  return {
+    id: msg.getAttribute('data-msgid'),
+    timestamp: timestamp ? parseInt(timestamp) : null,
+    date: timestamp ? new Date(parseInt(timestamp) * 1000).toLocaleString() : null,
+    isOutgoing: isOutgoing,
+    peerId: msg.getAttribute('data-peer'),
+    text: text,
+    role: isOutgoing ? 'assistant' : 'user'
+  };
+}
+
+function updateMessage(node) {
+  const key = messageKey(node);
+  const entry = messageStore.get(key);
+  if (entry && entry.node === node) {
+    entry.message = readMessage(node);
+    return;
+  }
+  // Новое сообщение или VK заменил узел целиком (например, при редактировании) - порядок пересобираем
+  messageStore.set(key, { node: node, message: readMessage(node) });
+  orderedMessages = null;
+}
+
+function pruneDetached() {
+  for (const [key, entry] of messageStore) {
+    if (!entry.node.isConnected) {
+      messageStore.delete(key);
+      orderedMessages = null;
+    }
+  }
+  needsPrune = false;
+}
+
 function extractMessages() {
-  const messages = [];
+  if (needsPrune) pruneDetached();
   
-  console.log('Начинаем извлечение сообщений...');
+  // Первое извлечение или смена разметки (например, открыт другой раздел VK)
+  if (needsFullScan || messageStore.size === 0) {
+    resolveSelector().forEach(node => pendingNodes.add(node));
+    needsFullScan = false;
+  }
   
-  // Пробуем разные селекторы для сообщений
-  let messageElements = document.querySelectorAll('.im-mess._im_mess');
-  console.log('Найдено элементов с .im-mess._im_mess:', messageElements.length);
+  if (pendingNodes.size > 0) {
+    debugLog('Перечитываем сообщений:', pendingNodes.size);
+    pendingNodes.forEach(node => {
+      if (node.isConnected) updateMessage(node);
+    });
+    pendingNodes.clear();
+  }
   
-  // Если не нашли, пробуем другие варианты
-  if (messageElements.length === 0) {
-    messageElements = document.querySelectorAll('[class*="im-mess"]');
-    console.log('Найдено элементов с [class*="im-mess"]:', messageElements.length);
+  if (orderedMessages === null) {
+    orderedMessages = Array.from(messageStore.values())
+      .sort((a, b) => (a.node.compareDocumentPosition(b.node) & Node.DOCUMENT_POSITION_FOLLOWING ? -1 : 1));
   }
   
-  if (messageElements.length === 0) {
-    messageElements = document.querySelectorAll('li[data-msgid]');
-    console.log('Найдено элементов с li[data-msgid]:', messageElements.length);
+  const messages = orderedMessages.map(entry => entry.message).filter(message => message.text);
+  debugLog('Всего извлечено сообщений:', messages.length);
+  return messages;
+}
+
+// Узлы сообщений внутри добавленного поддерева (только в нём, а не во всём документе)
+function collectMessageNodes(node, selector, result) {
+  if (node.nodeType !== Node.ELEMENT_NODE) return;
+  if (node.matches(selector)) result.push(node);
+  node.querySelectorAll(selector).forEach(child => result.push(child));
+}
+
+// Возвращает true, если появились новые сообщения
+function trackMutations(mutations) {
+  let added = false;
+  if (!messageSelector) {
+    // Сообщений ещё не было - ждём их появления и тогда определяем селектор
+    added = mutations.some(mutation => Array.from(mutation.addedNodes).some(node =>
+      node.nodeType === Node.ELEMENT_NODE &&
+      (node.matches('[data-msgid]') || node.querySelector('[data-msgid]'))
+    ));
+    if (added) needsFullScan = true;
+    return added;
   }
   
-  messageElements.forEach((msg, index) => {
-    console.log(`Обработка сообщения ${index}:`, msg.className);
-    
-    const isOutgoing = msg.classList.contains('im-mess_out');
-    const timestamp = msg.getAttribute('data-ts');
-    const msgId = msg.getAttribute('data-msgid');
-    const peerId = msg.getAttribute('data-peer');
-    
-    // Пробуем разные селекторы для текста
-    let textElement = msg.querySelector('.im-mess--text');
-    if (!textElement) {
-      textElement = msg.querySelector('[class*="mess--text"]');
-    }
-    if (!textElement) {
-      textElement = msg.querySelector('.message_text');
-    }
+  for (const mutation of mutations) {
+    if (mutation.removedNodes.length > 0) needsPrune = true;
     
-    let text = textElement ? textElement.innerText.trim() : '';
-    
-    // Если не нашли текст, берем весь текст из элемента
-    if (!text) {
-      text = msg.innerText.trim();
+    const addedMessages = [];
+    mutation.addedNodes.forEach(node => collectMessageNodes(node, messageSelector, addedMessages));
+    if (addedMessages.length > 0) {
+      addedMessages.forEach(node => pendingNodes.add(node));
+      orderedMessages = null;
+      added = true;
     }
     
-    console.log(`Сообщение ${index}: текст = "${text.substring(0, 50)}...", isOutgoing = ${isOutgoing}`);
-    
-    if (text) {
-      messages.push({
-        id: msgId,
-        timestamp: timestamp ? parseInt(timestamp) : null,
-        date: timestamp ? new Date(parseInt(timestamp) * 1000).toLocaleString() : null,
-        isOutgoing: isOutgoing,
-        peerId: peerId,
-        text: text,
-        role: isOutgoing ? 'assistant' : 'user'
-      });
-    }
-  });
-  
-  console.log('Всего извлечено сообщений:', messages.length);
-  return messages;
+    // Изменение внутри уже известного сообщения (редактирование, подгрузка текста)
+    const target = mutation.target.nodeType === Node.ELEMENT_NODE ? mutation.target : mutation.target.parentElement;
+    const changed = target && target.closest(messageSelector);
+    if (changed) pendingNodes.add(changed);
+  }
+  return added;
 }
 
 // Слушаем запросы от popup
 chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
-  console.log('Получен запрос:', request);
+  debugLog('Получен запрос:', request);
   
   if (request.action === 'getMessages') {
     const messages = extractMessages();
-    console.log('Отправляем сообщения:', messages.length);
+    debugLog('Отправляем сообщения:', messages.length);
     sendResponse({ messages: messages });
   }
   return true;
 });
 
+// Упреждающая генерация: при новом входящем сообщении сервер заранее готовит ответ,
+// и popup показывает его сразу после открытия
+// (API_URL, CANDIDATE_COUNT и формат запроса - общие с popup, в api.js)
+const PREFETCH_DEBOUNCE_MS = 1500;
+
+let prefetchTimer = null;
+let lastPrefetchedId = null;
+
+async function prefetchSuggestion() {
+  const messages = extractMessages();
+  if (messages.length === 0) return;
+  
+  // Ответ нужен только на новое входящее сообщение
+  const last = messages[messages.length - 1];
+  if (last.isOutgoing || !last.peerId || last.id === lastPrefetchedId) return;
+  if (!messages.every(msg => msg.id)) return;
+  lastPrefetchedId = last.id;
+  
+  const { headers, body } = await encodeRequest({
+    ...toCompactMessages(messages),
+    context: '',
+    peer_id: last.peerId,
+    candidate_count: CANDIDATE_COUNT
+  });
+  
+  try {
+    await fetch(`${API_URL}/api/prefetch`, { method: 'POST', headers: headers, body: body });
+  } catch (error) {
+    console.warn('Prefetch не отправлен:', error);
+  }
+}
+
+// Пачку изменений DOM (несколько сообщений подряд) обрабатываем один раз
+function schedulePrefetch() {
+  clearTimeout(prefetchTimer);
+  prefetchTimer = setTimeout(prefetchSuggestion, PREFETCH_DEBOUNCE_MS);
+}
+
+// Один наблюдатель и обновляет хранилище сообщений, и запускает prefetch
+const messageObserver = new MutationObserver(mutations => {
+  if (trackMutations(mutations)) {
+    schedulePrefetch();
+  }
+});
+messageObserver.observe(document.body, { childList: true, subtree: true, characterData: true });
+
 console.log('Respondo content script loaded');
\ No newline at end of file
@@ -1,5 +1,5 @@
+// API_URL, CANDIDATE_COUNT и помощники запросов - в api.js
 let currentMessages = [];
-const API_URL = 'http://localhost:8000';
 
 // Элементы интерфейса
 const loadingContainer = document.getElementById('loadingContainer');
@@ -9,6 +9,17 @@ const timerElement = document.getElementById('timer');
 const timeInfoElement = document.getElementById('timeInfo');
 const aiResponseText = document.getElementById('aiResponseText');
 const errorMessage = document.getElementById('errorMessage');
+const candidateSwitcher = document.getElementById('candidateSwitcher');
+const candidateLabel = document.getElementById('candidateLabel');
+const acceptBtn = document.getElementById('acceptBtn');
+
+let candidates = [];
+let candidateIndex = 0;
+
+// Сообщения, на которые показан ответ: выбранный ответ уходит на сервер как принятый,
+// только когда оператор явно нажал "Ответ подходит" (копируется в буфер любой показанный ответ)
+let answeredMessages = null;
+const ACCEPTED_TAIL_MESSAGES = 5;
 
 // Секундомер
 let startTime;
@@ -70,10 +81,8 @@ function fallbackCopy(text) {
   document.body.removeChild(textarea);
 }
 
-// Показать результат
-function showResult(text, elapsedMs) {
-  const finalTime = stopTimer();
-  
+// Открыть окно результата (вызывается на первом токене)
+function openResultView() {
   // Расширяем окно для показа результата
   document.body.style.width = '450px';
   document.body.style.padding = '15px';
@@ -81,15 +90,43 @@ function showResult(text, elapsedMs) {
   loadingContainer.classList.add('hidden');
   resultContainer.classList.add('show');
   errorContainer.classList.remove('show');
+}
+
+// Показать результат
+function showResult(text, firstTokenMs) {
+  const finalTime = stopTimer();
+  
+  openResultView();
   
-  timeInfoElement.textContent = `⏱ Время генерации: ${formatFinalTime(finalTime)}`;
+  timeInfoElement.textContent = firstTokenMs != null
+    ? `⏱ Первый токен: ${formatFinalTime(firstTokenMs)} · Всего: ${formatFinalTime(finalTime)}`
+    : `⏱ Время генерации: ${formatFinalTime(finalTime)}`;
   aiResponseText.value = text;
+  acceptBtn.disabled = false;
+  acceptBtn.textContent = '👍 Ответ подходит';
   
   // Автоматически копируем в буфер обмена
   copyToClipboard(text);
   console.log('Ответ скопирован в буфер обмена');
 }
 
+// Показать переключатель, если сервер вернул несколько вариантов
+function showCandidates(list) {
+  candidates = list && list.length > 1 ? list : [];
+  candidateIndex = 0;
+  candidateSwitcher.classList.toggle('show', candidates.length > 1);
+  candidateLabel.textContent = `1 / ${candidates.length}`;
+}
+
+// Переход к соседнему варианту (по кругу)
+function selectCandidate(delta) {
+  if (candidates.length < 2) return;
+  candidateIndex = (candidateIndex + delta + candidates.length) % candidates.length;
+  aiResponseText.value = candidates[candidateIndex];
+  candidateLabel.textContent = `${candidateIndex + 1} / ${candidates.length}`;
+  copyToClipboard(candidates[candidateIndex]);
+}
+
 // Показать ошибку
 function showError(errorText) {
   stopTimer();
@@ -138,6 +175,81 @@ async function loadMessages() {
   }
 }
 
+// Чтение server-sent событий из потока ответа
+async function readServerSentEvents(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    
+    buffer += decoder.decode(value, { stream: true });
+    
+    // События разделяются пустой строкой
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      
+      let eventName = 'message';
+      const dataLines = [];
+      for (const line of rawEvent.split('\n')) {
+        if (line.startsWith('event:')) {
+          eventName = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+          dataLines.push(line.slice(5).trim());
+        }
+      }
+      
+      if (dataLines.length > 0) {
+        onEvent(eventName, JSON.parse(dataLines.join('\n')));
+      }
+    }
+  }
+}
+
+// Последний id сообщения, уже отправленный на сервер для этого диалога
+async function getSessionAck(peerId) {
+  const key = `sessionAck:${peerId}`;
+  const data = await chrome.storage.local.get(key);
+  return data[key] || null;
+}
+
+async function setSessionAck(peerId, messageId) {
+  await chrome.storage.local.set({ [`sessionAck:${peerId}`]: messageId });
+}
+
+// Сколько секунд ждать, если сервер как раз готовит ответ заранее (дешевле, чем второй вызов LLM)
+const PREFETCH_WAIT_SECONDS = 15;
+
+// Ответ, заранее подготовленный сервером к последнему сообщению (или null)
+async function getPrefetchedReply(peerId, lastMessageId) {
+  try {
+    const params = new URLSearchParams({ last_message_id: lastMessageId, wait: PREFETCH_WAIT_SECONDS });
+    const response = await fetch(`${API_URL}/api/prefetch/${encodeURIComponent(peerId)}?${params}`, {
+      headers: { 'X-Install-Id': await getInstallId() }
+    });
+    if (!response.ok) return null;
+    const data = await response.json();
+    return data.status === 'ready' ? data : null;
+  } catch (error) {
+    console.warn('Не удалось получить подготовленный ответ:', error);
+    return null;
+  }
+}
+
+// Отправка запроса на потоковый endpoint
+async function postSuggestStream(requestData) {
+  const { headers, body } = await encodeRequest(requestData);
+  return fetch(`${API_URL}/api/suggest-reply/stream`, {
+    method: 'POST',
+    headers: headers,
+    body: body
+  });
+}
+
 // Генерация ответа
 async function generateResponse() {
   try {
@@ -151,39 +263,96 @@ async function generateResponse() {
       throw new Error('Не удалось загрузить сообщения из диалога');
     }
     
+    // Если у сообщений есть id диалога и сообщений, сервер хранит историю сам,
+    // и отправлять нужно только сообщения новее последнего подтверждённого
+    const peerId = messages[messages.length - 1].peerId;
+    const useSession = Boolean(peerId) && messages.every(msg => msg.id);
+    
+    // Если сервер уже подготовил ответ на последнее сообщение, показываем его сразу
+    if (useSession) {
+      const prefetched = await getPrefetchedReply(peerId, messages[messages.length - 1].id);
+      if (prefetched) {
+        console.log('Ответ подготовлен заранее:', prefetched);
+        showResult(prefetched.suggested_reply);
+        showCandidates(prefetched.candidates);
+        answeredMessages = messages;
+        timeInfoElement.textContent = `⚡ Подготовлен заранее · ${formatFinalTime(Date.now() - startTime)}`;
+        return;
+      }
+    }
+    
+    const ackId = useSession ? await getSessionAck(peerId) : null;
+    const newMessages = ackId
+      ? messages.filter(msg => Number(msg.id) > Number(ackId))
+      : messages;
+    
     // Формируем данные для API
     const requestData = {
-      messages: messages.map(msg => ({
-        author: msg.role === 'user' ? 'Клиент' : 'Вы',
-        timestamp: msg.date || new Date(msg.timestamp * 1000).toISOString(),
-        content: msg.text
-      })),
-      context: ""
+      ...toCompactMessages(newMessages),
+      context: "",
+      candidate_count: CANDIDATE_COUNT
     };
+    if (useSession) {
+      requestData.peer_id = peerId;
+      requestData.base_message_id = ackId;
+      requestData.reset_session = !ackId;
+    }
     
     console.log('Отправка запроса:', requestData);
     
-    // Отправляем запрос на FastAPI
-    const response = await fetch(`${API_URL}/api/suggest-reply`, {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify(requestData)
-    });
+    // Отправляем запрос на FastAPI (потоковый endpoint)
+    let response = await postSuggestStream(requestData);
+    
+    if (response.status === 409 && useSession) {
+      // Сервер потерял сессию - отправляем всю историю заново
+      console.log('Сессия рассинхронизирована, отправляем всю историю');
+      response = await postSuggestStream({
+        ...requestData,
+        ...toCompactMessages(messages),
+        base_message_id: null,
+        reset_session: true
+      });
+    }
     
     if (!response.ok) {
       const errorData = await response.json().catch(() => ({}));
       throw new Error(errorData.detail || `Ошибка сервера: ${response.status}`);
     }
     
-    const data = await response.json();
-    console.log('Получен ответ:', data);
+    // Выводим токены в окно по мере поступления
+    let firstTokenMs = null;
+    let finalData = null;
+    aiResponseText.value = '';
+    
+    await readServerSentEvents(response, (eventName, data) => {
+      if (eventName === 'token') {
+        if (firstTokenMs === null) {
+          firstTokenMs = Date.now() - startTime;
+          openResultView();
+          timeInfoElement.textContent = `⏱ Первый токен: ${formatFinalTime(firstTokenMs)} · генерация...`;
+        }
+        aiResponseText.value += data.text;
+      } else if (eventName === 'done') {
+        finalData = data;
+      } else if (eventName === 'error') {
+        throw new Error(data.detail || 'Ошибка сервера при генерации');
+      }
+    });
+    
+    if (!finalData) {
+      throw new Error('Ошибка сервера: поток ответа прерван');
+    }
+    console.log('Получен ответ:', finalData);
+    
+    if (useSession && finalData.session_last_message_id) {
+      await setSessionAck(peerId, finalData.session_last_message_id);
+    }
     
     // Показываем результат
-    const responseText = data.suggested_reply || 'Ответ получен, но текст пуст';
-    const elapsedMs = Date.now() - startTime;
-    showResult(responseText, elapsedMs);
+    const responseText = finalData.suggested_reply || 'Ответ получен, но текст пуст';
+    showResult(responseText, firstTokenMs);
+    showCandidates(finalData.candidates);
+    answeredMessages = messages;
     
   } catch (error) {
     console.error('Ошибка при генерации:', error);
@@ -204,6 +373,35 @@ async function generateResponse() {
   }
 }
 
+// Сообщаем серверу, какой ответ оператор одобрил (для индекса принятых ответов)
+async function reportAcceptedReply() {
+  const reply = aiResponseText.value.trim();
+  if (!answeredMessages || !reply) return;
+  acceptBtn.disabled = true;
+  try {
+    const response = await fetch(`${API_URL}/api/replies/accepted`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'X-Install-Id': await getInstallId() },
+      body: JSON.stringify({
+        ...toCompactMessages(answeredMessages.slice(-ACCEPTED_TAIL_MESSAGES)),
+        reply: reply
+      }),
+      keepalive: true  // Запрос должен уйти, даже если popup сразу закроют
+    });
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    answeredMessages = null;
+    acceptBtn.textContent = '✅ Запомнено';
+  } catch (error) {
+    console.warn('Не удалось сохранить принятый ответ:', error);
+    acceptBtn.disabled = false;
+  }
+}
+
+acceptBtn.addEventListener('click', reportAcceptedReply);
+
+document.getElementById('prevCandidate').addEventListener('click', () => selectCandidate(-1));
+document.getElementById('nextCandidate').addEventListener('click', () => selectCandidate(1));
+
 // Обработчик кнопки повтора
 document.getElementById('retryBtn').addEventListener('click', () => {
   // Возвращаем компактное окно